@@ -0,0 +1,35 @@
+'''
+Time to import the GUI (each run in a fresh interpreter), and to the first databroker
+access through the lazy backend registry of databroker_api:
+
+    python benchmarks/bench_gui_import.py [num_runs]
+
+The package is imported from this source tree.
+'''
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == '__main__':
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for label, code in [("import nsls2ptycho.ptycho_gui", "import nsls2ptycho.ptycho_gui"),
+                        ("  + first get_db()", "import nsls2ptycho.ptycho_gui\n"
+                                               "from nsls2ptycho.core.databroker_api import get_db\n"
+                                               "get_db()")]:
+        timings = []
+        for _ in range(num_runs):
+            t0 = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                  cwd=root)
+            timings.append(time.perf_counter() - t0)
+            if proc.returncode != 0:
+                print(proc.stderr.decode('utf-8').strip().splitlines()[-1], file=sys.stderr)
+                break
+        else:
+            timings.sort()
+            print("{:32s} median {:7.3f} s  (min {:.3f} s, {} runs)".format(
+                  label, timings[len(timings)//2], timings[0], num_runs))
@@ -0,0 +1,53 @@
+'''
+Write throughput, file size and random single-frame read latency of DiffampWriter for
+each supported compression, on sparse diffraction-like amplitudes:
+
+    python benchmarks/bench_h5.py [num_frames] [frame_size] [output_dir]
+'''
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import h5py
+
+# import the core modules as siblings, as their "for test purpose" fallbacks do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nsls2ptycho', 'core'))
+from ptycho_h5 import DiffampWriter, supported_compression
+
+
+if __name__ == '__main__':
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+    out_dir = sys.argv[3] if len(sys.argv) > 3 else tempfile.gettempdir()
+
+    # sparse diffraction-like amplitudes: bright center, mostly zeros after thresholding
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[-size//2:size//2, -size//2:size//2]
+    envelope = 1e4 * np.exp(-(xx**2 + yy**2) / (2*(size/16)**2))
+    data = rng.poisson(envelope + 0.2, size=(256, size, size)).astype(np.float64)
+    data[data < 1.] = 0.
+    data = np.fft.fftshift(np.sqrt(data), axes=(1, 2))
+
+    print("{:>6s} {:>12s} {:>12s} {:>16s}".format("filter", "write MB/s", "size (MB)", "random read (ms)"))
+    for compression in supported_compression:
+        file_path = os.path.join(out_dir, 'bench_scan_{}.h5'.format(compression))
+        t0 = time.perf_counter()
+        with DiffampWriter(file_path, (size, size), compression=compression) as writer:
+            for start in range(0, num_frames, data.shape[0]):
+                block = data[:min(data.shape[0], num_frames-start)]
+                writer.append(block, np.zeros((2, block.shape[0])))
+        t1 = time.perf_counter()
+        file_size = os.path.getsize(file_path)
+
+        indices = rng.integers(0, num_frames, 200)
+        with h5py.File(file_path, 'r') as f:
+            dset = f['diffamp']
+            t2 = time.perf_counter()
+            for i in indices:
+                dset[i]
+            t3 = time.perf_counter()
+        os.remove(file_path)
+
+        print("{:>6s} {:12.1f} {:12.1f} {:16.3f}".format(compression, num_frames*size*size*8/(t1-t0)/2**20,
+                                                        file_size/2**20, (t3-t2)/len(indices)*1e3))
@@ -0,0 +1,51 @@
+'''
+Generate a synthetic scan in the LOCAL backend's layout, then time load_metadata() and
+save_data() (the crop) on it:
+
+    python benchmarks/bench_local_crop.py [num_frames] [frame_size] [roi_size] [work_dir]
+'''
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+# import the core modules as siblings, as their "for test purpose" fallbacks do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nsls2ptycho', 'core'))
+from LOCAL_databroker import LocalDB, make_scan, load_metadata, save_data
+from ptycho_param import Param
+
+
+if __name__ == '__main__':
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 515
+    roi_size = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+    work_dir = sys.argv[4] if len(sys.argv) > 4 else tempfile.mkdtemp()
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[-size//2:size//2, -size//2:size//2]
+    envelope = 1e3 * np.exp(-(xx**2 + yy**2) / (2*(roi_size/8)**2)) + 0.5
+    frames = (rng.poisson(envelope).astype(np.uint32) for _ in range(num_frames))
+    points = rng.uniform(-1., 1., size=(2, num_frames))
+    ic = rng.uniform(9e4, 1.1e5, size=num_frames)
+    db = LocalDB(os.path.join(work_dir, 'data'))
+    t0 = time.perf_counter()
+    make_scan(db.root, 1, frames, points, ic, fmt='h5', x_range=2., y_range=2., dr_x=0.05, dr_y=0.05)
+    t1 = time.perf_counter()
+
+    param = Param()
+    param.working_directory = work_dir
+    param.detectorkind = 'merlin1'
+    param.z_m = 0.5
+    param.crop_cache_flag = False
+    metadata = load_metadata(db, 1, 'merlin1')
+    t2 = time.perf_counter()
+    param.__dict__.update(metadata)
+    param.lambda_nm = 1.2398/param.xray_energy_kev
+    save_data(db, param, 1, roi_size, roi_size, size//2, size//2)
+    t3 = time.perf_counter()
+
+    print("scan of {} frames of {}x{} in {}".format(num_frames, size, size, work_dir))
+    print("write raw frames:   {:8.2f} s".format(t1-t0))
+    print("load_metadata:      {:8.2f} s".format(t2-t1))
+    print("save_data (crop):   {:8.2f} s  ({:.1f} frames/s)".format(t3-t2, num_frames/(t3-t2)))
@@ -0,0 +1,43 @@
+'''
+Throughput of the block-wise preprocessing engine against the frame-by-frame loop it
+replaces:
+
+    python benchmarks/bench_preprocess.py [num_frames] [frame_size] [roi_size]
+'''
+import os
+import sys
+import time
+import numpy as np
+
+# import the core modules as siblings, as their "for test purpose" fallbacks do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nsls2ptycho', 'core'))
+from ptycho_preprocess import block_size, preprocess_frames
+from legacy import preprocess_frames_loop
+
+
+if __name__ == '__main__':
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 515
+    roi_size = int(sys.argv[3]) if len(sys.argv) > 3 else 128
+
+    rng = np.random.default_rng(0)
+    frames = rng.poisson(5., size=(num_frames, size, size)).astype(np.uint32)
+    scale = rng.uniform(0.9, 1.1, size=num_frames)
+    bad_pixels = [list(rng.integers(1, size, 200)), list(rng.integers(1, size, 200))]
+    zero_out = [(size//2, size//2, 10, 10)]
+    args = (roi_size, roi_size, size//2, size//2)
+    kwargs = dict(threshold=1., bad_pixels=bad_pixels, zero_out=zero_out)
+
+    t0 = time.perf_counter()
+    ref, ref_dark = preprocess_frames_loop(frames, *args, scale=scale, **kwargs)
+    t1 = time.perf_counter()
+    out = np.empty_like(ref)
+    dark = np.empty_like(ref_dark)
+    for start in range(0, num_frames, block_size):
+        stop = min(start+block_size, num_frames)
+        out[start:stop], dark[start:stop] = preprocess_frames(frames[start:stop], *args, scale=scale[start:stop], **kwargs)
+    t2 = time.perf_counter()
+
+    assert np.allclose(out, ref, equal_nan=True) and np.array_equal(dark, ref_dark)
+    print("frame-by-frame loop: {:10.1f} frames/s".format(num_frames/(t1-t0)))
+    print("block of {:4d}:      {:10.1f} frames/s".format(block_size, num_frames/(t2-t1)))
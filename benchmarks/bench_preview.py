@@ -0,0 +1,90 @@
+'''
+Latency from a (synthetic) ptycho process calling SharedPreview.write() to the GUI side
+holding the images to redraw, when signaled through the semaphore or by stdout:
+
+    python benchmarks/bench_preview.py [num_snapshots]
+'''
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from posix_ipc import SharedMemory, ExistentialError
+
+# import the core modules as siblings, as their "for test purpose" fallbacks do
+core_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nsls2ptycho', 'core')
+sys.path.insert(0, core_dir)
+from ptycho_preview import SharedPreview, PreviewWatcher, get_preview_shm_name
+from process_monitor import ProcessMonitor
+
+
+if __name__ == '__main__':
+    num_snapshots = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    child = '''
+import sys, time
+import numpy as np
+sys.path.insert(0, {path!r})
+from ptycho_preview import SharedPreview
+preview = SharedPreview.create({shm_name!r}, 4, (1, 256, 256), (1, 2000, 2000), np.float32, max_size=400)
+prb = np.ones((1, 256, 256), dtype=np.complex64)
+obj = np.ones((1, 2000, 2000), dtype=np.complex64)
+published = []
+for it in range({num_snapshots}):
+    time.sleep(0.01)  # the iterations in between
+    published.append(time.perf_counter())
+    preview.write(it, prb, obj)
+    print('[INFO] DM %d object_chi = 0.5 probe_chi = 0.25 diff_chi = 0.125' % it, flush={flush})
+np.save({times_path!r}, published)
+preview.close()  # the GUI unlinks it
+'''
+    times_path = os.path.join(tempfile.gettempdir(), 'ptycho_preview_bench_{}.npy'.format(os.getpid()))
+
+    for label, flush in (('semaphore', False), ('stdout (block-buffered)', False), ('stdout (flushed)', True)):
+        shm_name = 'ptycho_bench_{}'.format(os.getpid())
+        received = {}
+        reader = {}
+
+        def on_ready(it):
+            # what the GUI does before redrawing
+            frame = reader['preview'].read_planes(it)
+            if frame is not None:
+                [np.rot90(plane[0]) for plane in frame[1:]]
+                received.setdefault(it, time.perf_counter())
+
+        def on_init(preview):
+            reader['preview'] = preview
+
+        def on_stdout(line):
+            tokens = line.split()
+            if len(tokens) > 2 and tokens[0] == '[INFO]':
+                if 'preview' not in reader:
+                    try:
+                        on_init(SharedPreview.open(shm_name))
+                    except ExistentialError as ex:
+                        print("[WARNING] Cannot open the preview: {}".format(ex), file=sys.stderr)
+                        return
+                on_ready(int(tokens[2]))
+
+        watcher = PreviewWatcher(shm_name, on_init, on_ready) if label == 'semaphore' else None
+        if watcher is not None:
+            watcher.start()
+        code = child.format(path=core_dir, shm_name=shm_name, num_snapshots=num_snapshots, flush=flush,
+                            times_path=times_path)
+        env = {key: value for key, value in os.environ.items() if key != 'PYTHONUNBUFFERED'}
+        with subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              env=env) as proc:
+            ProcessMonitor(proc, on_stdout=None if watcher else on_stdout,
+                           on_stderr=lambda line: print(line, end='', file=sys.stderr)).run()
+        if watcher is not None:
+            time.sleep(0.3)
+            watcher.stop()
+        if 'preview' in reader:
+            reader['preview'].close()
+        SharedMemory(get_preview_shm_name(shm_name)).unlink()
+
+        published = np.load(times_path)
+        os.remove(times_path)
+        latency = np.array([received[it] - published[it] for it in sorted(received)]) * 1e3
+        print("{:24s} median {:8.3f} ms  p99 {:8.3f} ms  max {:8.3f} ms  ({} of {} snapshots seen)".format(
+              label, np.median(latency), np.percentile(latency, 99), latency.max(), len(received), num_snapshots))
@@ -0,0 +1,59 @@
+'''
+CPU time spent by the mpirun output monitor on a synthetic child that bursts output,
+then stays quiet while writing to stderr only, and finally sends telemetry records;
+ProcessMonitor against the polling loop it replaces:
+
+    python benchmarks/bench_process_monitor.py [num_lines]
+'''
+import os
+import subprocess
+import sys
+import time
+
+# import the core modules as siblings, as their "for test purpose" fallbacks do
+core_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nsls2ptycho', 'core')
+sys.path.insert(0, core_dir)
+from process_monitor import ProcessMonitor
+from ptycho_telemetry import TelemetryReceiver
+from legacy import legacy_monitor
+
+
+child = '''
+import sys, time, os
+sys.path.insert(0, {path!r})
+from ptycho_telemetry import TelemetrySender
+for i in range({num_lines}):
+    sys.stdout.write('[INFO] DM %d object_chi = 0.5 probe_chi = 0.25 diff_chi = 0.125\\n' % i)
+sys.stdout.flush()
+for i in range(20):  # quiet period, with sparse stderr output
+    time.sleep(0.1)
+    sys.stderr.write('still working %d\\n' % i)
+    sys.stderr.flush()
+telemetry = TelemetrySender.from_env()
+for i in range(100):
+    telemetry.send_iteration(i, 'DM', 0.1, probe_chi=[0.25], object_chi=[0.5], diff_chi=[0.125])
+'''
+
+
+if __name__ == '__main__':
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    code = child.format(path=core_dir, num_lines=num_lines)
+
+    for label in ('legacy polling loop', 'ProcessMonitor'):
+        counts = {'stdout': 0, 'stderr': 0, 'telemetry': 0}
+        def count(name):
+            def _count(item):
+                counts[name] += len(item) if name == 'telemetry' else 1
+            return _count
+        with TelemetryReceiver() as telemetry:
+            t0, c0 = time.perf_counter(), time.process_time()
+            with subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  env=dict(os.environ, **telemetry.env)) as proc:
+                if label == 'ProcessMonitor':
+                    ProcessMonitor(proc, count('stdout'), count('stderr'), telemetry, count('telemetry')).run()
+                else:
+                    legacy_monitor(proc, count('stdout'), count('stderr'))
+                    count('telemetry')(telemetry.read())
+            wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        print("{:20s} wall {:6.2f} s  monitor CPU {:6.2f} s ({:5.1f}%)  lines {}/{}  records {}".format(
+              label, wall, cpu, 100*cpu/wall, counts['stdout'], counts['stderr'], counts['telemetry']))
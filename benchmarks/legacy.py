@@ -0,0 +1,44 @@
+'''
+The implementations that the vectorized and event-driven code in nsls2ptycho.core
+replaced, kept as references for the benchmarks in this directory and for the tests.
+'''
+import os
+from fcntl import fcntl, F_GETFL, F_SETFL
+import numpy as np
+
+
+def preprocess_frames_loop(frames, n, nn, cx, cy, scale=None, threshold=None, bad_pixels=None, zero_out=None):
+    # the frame-by-frame crop of HXN's save_data that ptycho_preprocess.preprocess_frames() replaces
+    diffamp = np.zeros((len(frames), n//2*2, nn//2*2))
+    dark = np.zeros(len(frames), dtype=bool)
+    for i, img in enumerate(frames):
+        img = img * scale[i] if scale is not None else img.astype(np.float64)
+        if bad_pixels is not None:
+            for x, y in zip(bad_pixels[0], bad_pixels[1]):
+                img[x, y] = np.median(img[x-1:x+1, y-1:y+1])
+        if zero_out is not None:
+            for x0, y0, w, h in zero_out:
+                img[y0:y0+h, x0:x0+w] = 0.
+        tmptmp = np.rot90(img[cy-nn//2:cy+nn//2, cx-n//2:cx+n//2], axes=(1,0))
+        dark[i] = not np.sum(tmptmp) > 0.
+        diffamp[i] = np.fft.fftshift(tmptmp)
+    if threshold is not None:
+        diffamp[diffamp < threshold] = 0.
+    return np.sqrt(diffamp), dark
+
+
+def legacy_monitor(process, on_stdout=None, on_stderr=None):
+    # the polling loop of PtychoReconWorker.recon_api that process_monitor.ProcessMonitor replaces
+    flags = fcntl(process.stderr, F_GETFL)
+    fcntl(process.stderr, F_SETFL, flags | os.O_NONBLOCK)
+    while True:
+        stdout = process.stdout.readline()
+        stderr = process.stderr.readline()
+        if (process.poll() is not None) and (stdout == b'') and (stderr == b''):
+            break
+        if stdout and on_stdout is not None:
+            on_stdout(stdout.decode('utf-8'))
+        if stderr and on_stderr is not None:
+            on_stderr(stderr.decode('utf-8'))
+    return process.poll()
+
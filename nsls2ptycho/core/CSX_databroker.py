@@ -1,19 +1,32 @@
 from databroker import Broker, get_table
 import numpy as np
 import sys, os
-import h5py
+import hashlib
 try:
-    from nsls2ptycho.core.widgets.imgTools import rm_outlier_pixels
+    from nsls2ptycho.core.ptycho_preprocess import block_size, preprocess_frames
+    from nsls2ptycho.core import metadata_cache
+    from nsls2ptycho.core.lru_cache import LRUCache
+    from nsls2ptycho.core.frame_cache import RawFrameCache
+    from nsls2ptycho._version import __version__
+    from nsls2ptycho.core.ptycho_h5 import (DiffampWriter, get_diffamp_dtype, get_crop_key, get_scan_file_path,
+                                            load_cached_scan, prune_cached_scans, link_scan_file)
 except ModuleNotFoundError:
     # for test purpose
-    from widgets.imgTools import rm_outlier_pixels
+    from ptycho_preprocess import block_size, preprocess_frames
+    import metadata_cache
+    from lru_cache import LRUCache
+    from frame_cache import RawFrameCache
+    __version__ = 'test'
+    from ptycho_h5 import (DiffampWriter, get_diffamp_dtype, get_crop_key, get_scan_file_path,
+                           load_cached_scan, prune_cached_scans, link_scan_file)
 
 try:
     csx_db = Broker.named('csx')
 except FileNotFoundError:
     print("csx.yml not found. Unable to access CSX's database.", file=sys.stderr)
     csx_db = None
-from csxtools.utils import get_fastccd_images, get_images_to_4D, get_fastccd_flatfield
+import csxtools
+from csxtools.utils import get_fastccd_images, get_fastccd_flatfield
 
 
 # ***************************** "Public API" *****************************
@@ -49,6 +62,9 @@ def load_metadata(db, scan_num:int, det_name:str=''):
     Return:
         A dictionary that holds the metadata (except for those directly related to the image)
     '''
+    metadata = metadata_cache.get('CSX', scan_num, det_name)
+    if metadata is not None:
+        return metadata
     header = db[scan_num]
     scan_data = header.table(fill=False, stream_name='primary')  # acquired counters during the scan/ct, images excluded
     scan_supp = header.table(fill=False, stream_name='baseline') # supplementary information, images excluded
@@ -123,6 +139,9 @@ def load_metadata(db, scan_num:int, det_name:str=''):
     metadata['ny'] = 960
     metadata['z_m'] = 0.34
 
+    # a finished scan does not change anymore
+    metadata_cache.put('CSX', scan_num, det_name, metadata, closed=bool(header.stop))
+
     return metadata
 
 
@@ -181,62 +200,145 @@ def save_data(db, param, scan_num:int, nx_prb:int, ny_prb:int, cx:int, cy:int, t
     #points[1] = scan_data.nanop_bz * 1000.
 
     # get the slicerator corresponding to the scan number
-    key = _expand_partial_key(scan_num)
-    itr = scan_image_itr_cache[key]
+    # (_expand_partial_key only returns cached keys: the index drops the evicted ones)
+    with scan_image_itr_cache.lock:
+        key = _expand_partial_key(scan_num)
+        itr = scan_image_itr_cache[key]
     assert num_frame == len(itr)
 
-    # get raw data
-    images_stack = get_images_to_4D(itr)
-    raw_mean_data = _preprocess_image(images_stack, bad_pixels, zero_out)
-
-    # construct data array
-    diffamp = np.empty((num_frame, nx_prb//2*2, ny_prb//2*2))
-    diffamp[...] = np.rot90(raw_mean_data[:, cy-ny_prb//2:cy+ny_prb//2, cx-nx_prb//2:cx+nx_prb//2], axes=(2, 1))  # equivalent to np.flipud(arr).T
-    diffamp = np.fft.fftshift(diffamp, axes=(1, 2))
-    diffamp = np.sqrt(diffamp)
-    diffamp[diffamp < threshold] = 0.
-    assert diffamp.shape == (num_frame, nx_prb, ny_prb)
-    print('array size:', diffamp.shape)
-
     # create a folder
     try:
         os.mkdir(param.working_directory + '/h5_data/')
     except FileExistsError:
         pass 
 
-    file_path = param.working_directory + '/h5_data/scan_' + str(scan_num) + '.h5'
-    with h5py.File(file_path, 'w') as hf:
-        dset = hf.create_dataset('diffamp', data=diffamp)
-        dset = hf.create_dataset('points', data=points)
-        dset = hf.create_dataset('x_range', data=param.x_range)
-        dset = hf.create_dataset('y_range', data=param.y_range)
-        dset = hf.create_dataset('dr_x', data=param.dr_x)
-        dset = hf.create_dataset('dr_y', data=param.dr_y)
-        dset = hf.create_dataset('z_m',data=det_distance_m)
-        dset = hf.create_dataset('lambda_nm',data=lambda_nm)
-        dset = hf.create_dataset('ccd_pixel_um',data=det_pixel_um)
-        dset = hf.create_dataset('angle',data=angle)
-        dset = hf.create_dataset('x_pixel_m',data=x_pixel_m)
-        dset = hf.create_dataset('y_pixel_m',data=y_pixel_m)
-        dset = hf.create_dataset('x_depth_field_m',data=x_depth_of_field_m)
-        dset = hf.create_dataset('y_depth_field_m',data=y_depth_of_field_m)
+    # reuse the previous result if the crop settings (including dark and flat-field scans) are unchanged
+    crop_key = get_crop_key(param, 'CSX', scan_num, len(itr), nx_prb, ny_prb, cx, cy, threshold, bad_pixels, zero_out,
+                            scan_key=key)
+    file_path = get_scan_file_path(param, scan_num, crop_key)
+    if not load_cached_scan(param, file_path, crop_key):
+        # construct data array and stream it to disk, one block of points at a time
+        # (the threshold applies to the amplitude, and the intensity is nonnegative after stitching)
+        rows = _get_roi_rows(ny_prb, cy)
+        zero_out = _shift_rois(zero_out, rows.start)
+        with DiffampWriter(file_path, (nx_prb//2*2, ny_prb//2*2),
+                           dtype=get_diffamp_dtype(param.h5_dtype, param.precision),
+                           compression=param.h5_compression, chunk_frames=param.h5_chunk_frames) as writer:
+            start = 0
+            for block in _iter_stitched_blocks(itr, rows):
+                stop = start + block.shape[0]
+                diffamp, _ = preprocess_frames(block, nx_prb, ny_prb, cx, cy - rows.start, threshold=threshold**2,
+                                               zero_out=zero_out)
+                writer.append(diffamp, points[:, start:stop])
+                start = stop
+            assert writer.shape == (num_frame, nx_prb, ny_prb)
+            print('array size:', writer.shape)
+
+            writer.write_metadata(x_range=param.x_range,
+                                  y_range=param.y_range,
+                                  dr_x=param.dr_x,
+                                  dr_y=param.dr_y,
+                                  z_m=det_distance_m,
+                                  lambda_nm=lambda_nm,
+                                  ccd_pixel_um=det_pixel_um,
+                                  angle=angle,
+                                  x_pixel_m=x_pixel_m,
+                                  y_pixel_m=y_pixel_m,
+                                  x_depth_field_m=x_depth_of_field_m,
+                                  y_depth_field_m=y_depth_of_field_m)
+            writer.write_attrs(crop_key=crop_key)
+        prune_cached_scans(param, scan_num)
 
     # symlink so ptycho can find it
-    try:
-        symlink_path = param.working_directory + '/scan_' + str(scan_num) + '.h5'
-        os.symlink(file_path, symlink_path)
-    except FileExistsError:
-        os.remove(symlink_path)
-        os.symlink(file_path, symlink_path)
+    link_scan_file(file_path, param.working_directory, scan_num)
+
+
+def _key_rank(key):
+    # how complete the dark/flat info of a key is: flat field > dark1 > dark2 > dark8 > none
+    if key[4][0] is not None:
+        return 5
+    elif key[3] is not None:
+        return 4
+    elif key[2] is not None:
+        return 3
+    elif key[1] is not None:
+        return 2
+    return 1
+
+
+# scan num -> {key: rank} for the keys in scan_image_itr_cache, in insertion order;
+# guarded by scan_image_itr_cache.lock, as scans are loaded from more than one thread
+_scan_key_index = {}
+
+
+def _index_key(key):
+    with scan_image_itr_cache.lock:
+        entries = _scan_key_index.setdefault(key[0], {})
+        entries.pop(key, None)  # re-inserted keys count as the latest
+        entries[key] = _key_rank(key)
+
+
+def _unindex_key(key):
+    with scan_image_itr_cache.lock:
+        entries = _scan_key_index.get(key[0])
+        if entries is not None:
+            entries.pop(key, None)
+            if not entries:
+                del _scan_key_index[key[0]]
+
 
 '''
 For actual scans:
-    key : value = (scan num, dark8 num, dark2 num, dark1 num) : slicerator
+    key : value = (scan num, dark8 num, dark2 num, dark1 num, key_flat) : slicerator
 
-For flat-field scans:
+For flat-field scans (a separate, larger tier, as a flat field is reused across many scans):
     key : value = (scan num, dark8 num, dark2 num, dark1 num) : flat image
 '''
-scan_image_itr_cache = {}
+scan_image_itr_cache = LRUCache(max_items=16, name='scan images', on_remove=_unindex_key)
+flat_field_cache = LRUCache(max_items=32, max_bytes=2*2**30, name='flat fields')
+
+
+def get_cache_stats():
+    '''
+    Return the hit/miss/eviction counts of the scan and flat-field caches.
+    '''
+    return {'scan': scan_image_itr_cache.stats, 'flat': flat_field_cache.stats}
+
+
+# computed flat fields are kept on disk across sessions. Averaged dark frames are not:
+# get_fastccd_images() only accepts the dark scans' headers and averages them itself,
+# and applying stored dark frames would mean relying on csxtools' private helpers
+calib_cache_dir = os.path.expanduser("~") + "/.ptycho_gui/csx_calib"
+calib_cache_budget = 2*2**30
+_calib_cache = None
+
+
+def _get_calib_version():
+    # the products depend on how csxtools computes them, so they are not reused across versions
+    version = 'nsls2ptycho {}, csxtools {}'.format(__version__, getattr(csxtools, '__version__', None))
+    return hashlib.sha1(version.encode()).hexdigest()[:12]
+
+
+def _get_calib_product(kind:str, scan_ids:tuple, compute):
+    '''
+    Return the calibration product (ex: 'flat') computed from the given scans,
+    memory-mapped from disk if an earlier session computed it, or else computed by
+    compute() and persisted.
+    '''
+    global _calib_cache
+    if _calib_cache is None:
+        try:
+            _calib_cache = RawFrameCache(calib_cache_dir, calib_cache_budget)
+        except OSError as ex:
+            print("[WARNING] Cannot create the calibration cache: {}".format(ex), file=sys.stderr)
+            return compute()
+    key = '_'.join([kind] + [str(scan_id) for scan_id in scan_ids] + [_get_calib_version()])
+    product = _calib_cache.get(key)
+    if product is None:
+        product = _calib_cache.put(key, compute())
+    else:
+        print("Loaded the {} of scan(s) {} from {}".format(kind, scan_ids, calib_cache_dir))
+    return product
 
 
 def _load_scan_image_itr(db, scan_num:int, dark8:int=None, dark2:int=None, dark1:int=None, key_flat:tuple=None):
@@ -250,10 +352,11 @@ def _load_scan_image_itr(db, scan_num:int, dark8:int=None, dark2:int=None, dark1
 
     flat_scan_num, flat_scan_dark8, flat_scan_num_dark2, flat_scan_dark1 = key_flat
     if flat_scan_num is not None:
-        flat_im = scan_image_itr_cache.get(key_flat)  # load flat field image from cache
+        flat_im = flat_field_cache.get(key_flat)  # load flat field image from cache
         if flat_im is None:
-            flat_im = get_fastccd_flatfield(db[flat_scan_num], dark=(db[flat_scan_dark8], db[flat_scan_num_dark2], db[flat_scan_dark1]))
-            scan_image_itr_cache[key_flat] = flat_im
+            flat_im = _get_calib_product('flat', key_flat, lambda: get_fastccd_flatfield(
+                db[flat_scan_num], dark=(db[flat_scan_dark8], db[flat_scan_num_dark2], db[flat_scan_dark1])))
+            flat_field_cache[key_flat] = flat_im
     else:
         flat_im = None
 
@@ -267,12 +370,13 @@ def get_single_image(db, frame_num, scan_num:int, dark8:int=None, dark2:int=None
     key_flat = (flat_scan_num, flat_scan_dark8, flat_scan_num_dark2, flat_scan_dark1)
     key = (scan_num, dark8, dark2, dark1, key_flat)
 
-    if key in scan_image_itr_cache:
-        return _preprocess_image(scan_image_itr_cache[key][frame_num])
-    else:
+    itr = scan_image_itr_cache.get(key)
+    if itr is None:
         itr = _load_scan_image_itr(db, scan_num, dark8, dark2, dark1, key_flat)
-        scan_image_itr_cache[key] = itr
-        return _preprocess_image(itr[frame_num])
+        with scan_image_itr_cache.lock:  # an eviction in between would leave a stale index entry
+            scan_image_itr_cache[key] = itr
+            _index_key(key)
+    return _preprocess_image(itr[frame_num])
 
 
 def _preprocess_image(img, bad_pixels=None, zero_out=None):
@@ -304,41 +408,81 @@ def _preprocess_image(img, bad_pixels=None, zero_out=None):
     return img
 
 
+def _get_roi_rows(ny_prb:int, cy:int):
+    # the detector rows covered by the ROI window
+    rows = slice(cy - ny_prb//2, cy + ny_prb//2)
+    if rows.start < 0:
+        raise ValueError("The ROI window exceeds the detector (cy={}, height={}).".format(cy, ny_prb))
+    return rows
+
+
+def _shift_rois(zero_out, row_offset:int):
+    # express the zero_out rois in the coordinates of frames starting at row_offset
+    if zero_out is None:
+        return None
+    shifted = []
+    for x0, y0, w, h in zero_out:
+        top, bottom = max(y0 - row_offset, 0), y0 + h - row_offset
+        if bottom > top:
+            shifted.append((x0, top, w, bottom - top))
+    return shifted
+
+
+def _iter_stitched_blocks(itr, rows:slice, size:int=None):
+    '''
+    Yield the frames of the slicerator, size at a time, as preprocess_frames() expects
+    them: the images of each scan point averaged and the stripe removed (the same as
+    _preprocess_image). Only the given rows are kept, so that a block stays small.
+
+    The frames are averaged straight into a preallocated (size, rows, width) buffer, with
+    the columns on either side of the stripe written to their final place, so no stitched
+    copy of a frame is made. The buffer is reused: a block is only valid until the next
+    one is requested.
+    '''
+    if size is None:
+        size = block_size
+    num_frames = len(itr)
+    buf = None      # the block of stitched frames
+    scratch = None  # the exposures of one scan point, clipped
+    k = 0
+    for frame_num in range(num_frames):
+        img = np.asarray(itr[frame_num])
+        if img.ndim != 3:
+            raise ValueError("The image array's shape is not supported.")
+        img = img[:, rows, :]
+        if scratch is None or scratch.shape != img.shape:
+            scratch = np.empty(img.shape, dtype=img.dtype)
+        if buf is None:
+            dtype = img.dtype if np.issubdtype(img.dtype, np.floating) else np.float64
+            buf = np.empty((min(size, num_frames), img.shape[1], cedge - cl), dtype=dtype)
+        np.copyto(scratch, img)
+        np.nan_to_num(scratch, copy=False)
+        scratch[scratch < 0.] = 0.  # needed due to dark subtraction
+        np.mean(scratch[..., :cs], axis=0, out=buf[k, :, :cs])
+        np.mean(scratch[..., cs+cl:cedge], axis=0, out=buf[k, :, cs:])
+        k += 1
+        if k == buf.shape[0]:
+            yield buf
+            k = 0
+    if k > 0:
+        yield buf[:k]
+
+
 def _expand_partial_key(scan_num:int):
     # get the full key based on scan_num
     # We don't wanna guess the dark IDs, so we rely on cached info
-    related_keys = {}
-    for key in scan_image_itr_cache:
-        if scan_num in key:
-            # sort key based on the number of provided dark IDs
-            # prefer a complete info
-            if key[4][0] is not None:  # found match with flat-field
-                related_keys[5] = key
-                break  # shortcut
-            if key[3] is not None:
-                related_keys[4] = key
-                break  # shortcut
-            elif key[2] is not None:
-                related_keys[3] = key
-            elif key[1] is not None:
-                related_keys[2] = key
-            else:
-                related_keys[1] = key
-
-    if 5 in related_keys:
-        key = related_keys[5]
-    elif 4 in related_keys:
-        key = related_keys[4]
-    elif 3 in related_keys:
-        key = related_keys[3]
-    elif 2 in related_keys:
-        key = related_keys[2]
-    elif 1 in related_keys:
-        key = related_keys[1]
+    with scan_image_itr_cache.lock:
+        entries = _scan_key_index.get(scan_num)
+        if not entries:
+            raise ValueError("Data for scan number {} not found: it was not loaded, or was evicted from the cache "
+                             "since (at most {} scans are kept). Please load the scan again.".format(
+                             scan_num, scan_image_itr_cache.max_items))
+
+        # prefer the most complete info; among equally complete ones, the latest loaded
+        key, rank = max(reversed(list(entries.items())), key=lambda item: item[1])
+    if rank == 1:
         print("[WARNING] Proceeding without dark IDs...", file=sys.stderr)
-    else:
-        raise ValueError("Data for scan number", scan_num, "not found. Forget to click load?")
-    print("Found", key) # "from", related_keys)
+    print("Found", key)
 
     return key
 
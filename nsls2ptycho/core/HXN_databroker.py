@@ -1,12 +1,25 @@
 from databroker.v0 import Broker
 import numpy as np
 import sys, os
-import h5py
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 try:
-    from nsls2ptycho.core.widgets.imgTools import rm_outlier_pixels
+    from nsls2ptycho.core.ptycho_preprocess import iter_blocks, preprocess_frames, array_ensure_positive_elements
+    from nsls2ptycho.core.frame_cache import get_raw_frame_cache
+    from nsls2ptycho.core.detector_health import PixelStatistics, classify_pixels, save_mask, summarize
+    from nsls2ptycho.core import metadata_cache
+    from nsls2ptycho.core.ptycho_h5 import (DiffampWriter, get_diffamp_dtype, get_crop_key, get_scan_file_path,
+                                            load_cached_scan, prune_cached_scans, link_scan_file)
 except ModuleNotFoundError:
     # for test purpose
-    from widgets.imgTools import rm_outlier_pixels
+    from ptycho_preprocess import iter_blocks, preprocess_frames, array_ensure_positive_elements
+    from frame_cache import get_raw_frame_cache
+    from detector_health import PixelStatistics, classify_pixels, save_mask, summarize
+    import metadata_cache
+    from ptycho_h5 import (DiffampWriter, get_diffamp_dtype, get_crop_key, get_scan_file_path,
+                           load_cached_scan, prune_cached_scans, link_scan_file)
 
 from hxntools.handlers import register
 from hxntools.scan_info import ScanInfo
@@ -31,61 +44,82 @@ except FileNotFoundError:
 # ************************************************************************
 
 
-def array_ensure_positive_elements(arr, name="array"):
-    """
-    Replace all zero or negative values in the array with the closest positive values.
-    Works only with 1D arrays. The array is processed in the reversed order to replace
-    zeros with the following (not preceding) values, because they are more likely to
-    be from the same subscan (HXN).
+def _retrieve_frame(db, datum_id):
+    return db.reg.retrieve(datum_id)[0]
 
-    The function will do nothing if there are no zeros or negative values in the array.
 
-    Parameters
-    ----------
-    arr: numpy.ndarray
-        Reference to 1D numpy array. The values are modified in place.
-    name: str
-        Data name to use in error messages.
+def _retrieve_frame_in_worker(datum_id):
+    # runs in a spawned process, which has its own connection (hxn_db) set up on import
+    return _retrieve_frame(hxn_db, datum_id)
 
-    Returns
-    -------
-    None
-    """
-    n_items_to_replace = sum(arr <= 0)
 
-    # Exit right away if there scaler data is valid (this should be true for correctly recorded scans)
-    if not n_items_to_replace:
+def _retrieve_frames(db, mds_table, start=0, stop=None, num_workers=1, use_processes=False):
+    '''
+    Yield the raw frames mds_table[start:stop] in order.
+
+    Up to num_workers frames are fetched and decoded concurrently, and at most
+    2*num_workers frames are held in flight, so the memory use does not grow with
+    the scan size. With use_processes=True the frames are retrieved in separate
+    processes (each connecting to HXN's database on its own), which sidesteps the
+    GIL for handlers that decode in Python; otherwise a thread pool is used.
+    '''
+    if stop is None:
+        stop = mds_table.shape[0]
+
+    if num_workers <= 1:
+        for i in range(start, stop):
+            yield _retrieve_frame(db, mds_table.iat[i])
         return
 
-    # TODO: the algorithm may be implemented more efficiently if needed. Scalers are loaded only once
-    #       per reconstruction, and the correction does not introduce noticable delay. Rewrite
-    #       the function if performance becomes an issue.
-    v_closest_positive = None
-    for v in np.flip(
-        arr
-    ):  # Initialize the algorithm with some valid value in case the 1st element is zero.
-        if v > 0:
-            v_closest_positive = v
-            break
-
-    n_replaced = 0
-    if v_closest_positive is not None:
-        for n in reversed(range(arr.size)):
-            if arr[n] <= 0:
-                print(
-                    f"{name.capitalize()} value {arr[n]} with index {n} is replaced "
-                    f"with the closest value {v_closest_positive}."
-                )
-                arr[n] = v_closest_positive
-                n_replaced += 1
-                if n_replaced == n_items_to_replace:
-                    break
-            else:
-                v_closest_positive = arr[n]
+    if use_processes:
+        executor = ProcessPoolExecutor(max_workers=num_workers,
+                                       mp_context=multiprocessing.get_context('spawn'))
+        fetch = lambda i: executor.submit(_retrieve_frame_in_worker, mds_table.iat[i])
+    else:
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+        fetch = lambda i: executor.submit(_retrieve_frame, db, mds_table.iat[i])
+
+    with executor:
+        pending = deque()
+        for i in range(start, stop):
+            pending.append(fetch(i))
+            if len(pending) >= 2*num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _raw_frame_key(mds_table):
+    # the datum IDs are unique, so the first and last ones identify the scan and the detector
+    key = '{}:{}:{}'.format(mds_table.iat[0], mds_table.iat[-1], mds_table.shape[0])
+    return 'hxn_' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _iter_raw_frames(db, param):
+    '''
+    Yield the first param.nz raw frames of the loaded scan, from the raw-frame cache if
+    possible. Otherwise the frames are retrieved from the database and, if they make up
+    the whole scan, spilled to the cache.
+    '''
+    # the cache always holds the whole scan: param.nz is lowered by the dark-frame
+    # removal of a previous crop, so it does not tell whether an entry is complete
+    num_frame = param.mds_table.shape[0]
+    cache = get_raw_frame_cache(param)
+    if cache is None:
+        frames = None
     else:
-        print(
-            f"The {name} contains no positive non-zero values. Computations are likely to fail."
-        )
+        key = _raw_frame_key(param.mds_table)
+        frames = cache.get(key)
+    if frames is not None and frames.shape[0] == num_frame:
+        print("Reading raw frames from cache...")
+        return iter(frames[:param.nz])
+
+    frames = _retrieve_frames(db, param.mds_table, 0, param.nz,
+                              num_workers=param.crop_num_workers,
+                              use_processes=(param.crop_pool == 'process'))
+    if cache is not None and param.nz == num_frame:
+        frames = cache.fill(key, frames, num_frame)
+    return frames
 
 
 def load_metadata(db, scan_num:int, det_name:str):
@@ -104,6 +138,9 @@ def load_metadata(db, scan_num:int, det_name:str):
         A dictionary that holds the metadata (except for those directly related to the image)
     '''
     sid = scan_num
+    metadata = metadata_cache.get('HXN', sid, det_name)
+    if metadata is not None:
+        return metadata
     header = db[sid]
 
     plan_args = header.start['plan_args']
@@ -189,9 +226,52 @@ def load_metadata(db, scan_num:int, det_name:str):
     metadata['ny'] = ny
     metadata['mds_table'] = mds_table
 
+    # a finished scan does not change anymore
+    metadata_cache.put('HXN', sid, det_name, metadata, closed=bool(header.stop))
+
     return metadata
 
 
+def _crop_to_h5(db, param, file_path, n, nn, cx, cy, threshold, bad_pixels, zero_out, metadata, crop_key):
+    # crop the frames block by block and stream them to disk
+    ic = param.ic
+    frames = _iter_raw_frames(db, param)
+    mask = []
+    stats = None
+    stride = max(param.detector_health_stride, 1)
+    with DiffampWriter(file_path, (n//2*2, nn//2*2),
+                       dtype=get_diffamp_dtype(param.h5_dtype, param.precision),
+                       compression=param.h5_compression, chunk_frames=param.h5_chunk_frames) as writer:
+        start = 0
+        for block in iter_blocks(frames):
+            stop = start + block.shape[0]
+            data, dark = preprocess_frames(block, n, nn, cx, cy, scale=ic[0]/ic[start:stop],
+                                           threshold=threshold, bad_pixels=bad_pixels, zero_out=zero_out)
+            writer.append(data[~dark], param.points[:, start:stop][:, ~dark])
+            mask.extend((np.flatnonzero(dark) + start).tolist())
+            if param.detector_health_flag:
+                # sample the raw frames for the detector-health analysis on the way
+                if stats is None:
+                    stats = PixelStatistics(block.shape[1:])
+                stats.update(block[(-start) % stride::stride])
+            start = stop
+
+        if len(mask) > 0:
+            print("Removing the dark frames:", mask, file=sys.stderr)
+            param.points = np.delete(param.points, mask, axis=1)
+            param.nz = param.nz - len(mask)
+        # data array got
+        print('array size:', writer.shape)
+
+        writer.write_metadata(**metadata)
+        writer.write_attrs(crop_key=crop_key)
+
+    if stats is not None and stats.num_frames > 0:
+        masks = classify_pixels(stats)
+        mask_path = save_mask(param.detectorkind, masks, stats.num_frames)
+        print("Detector health ({} frames): {}. Saved to {}".format(stats.num_frames, summarize(masks), mask_path))
+
+
 def save_data(db, param, scan_num:int, n:int, nn:int, cx:int, cy:int, threshold=1., bad_pixels=None, zero_out=None):
     '''
     Save metadata and diffamp for the given scan number to a HDF5 file.
@@ -223,7 +303,6 @@ def save_data(db, param, scan_num:int, n:int, nn:int, cx:int, cy:int, threshold=
     '''
     det_distance_m = param.z_m
     det_pixel_um = param.ccd_pixel_um
-    num_frame = param.nz
     angle = param.angle
     lambda_nm = param.lambda_nm
     ic = param.ic
@@ -239,104 +318,59 @@ def save_data(db, param, scan_num:int, n:int, nn:int, cx:int, cy:int, threshold=
     #print('pixel size: ', x_pixel_m, y_pixel_m)
     #print('depth of field: ', x_depth_of_field_m, y_depth_of_field_m)
 
-    # get data array
-    data = np.zeros((num_frame, n//2*2, nn//2*2)) # nz*nx*ny
-    mask = []
-    for i in range(num_frame):
-        #print(param.mds_table.iat[i], file=sys.stderr)
-        img = db.reg.retrieve(param.mds_table.iat[i])[0]
-        #img = np.rot90(img, axes=(1,0)) #equivalent to tt = np.flipud(tt).T
-        ny, nx = np.shape(img)
-
-        img = img * ic[0] / ic[i]
-
-        if bad_pixels is not None:
-            img = rm_outlier_pixels(img, bad_pixels[0], bad_pixels[1])
-
-        if zero_out is not None:
-            for blue_roi in zero_out:
-                x0 = blue_roi[0]
-                y0 = blue_roi[1]
-                w = blue_roi[2]
-                h = blue_roi[3]
-                img[y0:y0+h, x0:x0+w] = 0.
-
-        if n < nx:
-            # assuming n=nn???
-            #print(nx, ny, file=sys.stderr)
-            #print(cx-n//2, cx+n//2, cy-nn//2, cy+nn//2, file=sys.stderr)
-            #tmptmp = img[cx-n//2:cx+n//2, cy-nn//2:cy+nn//2]
-            tmptmp = img[cy-nn//2:cy+nn//2, cx-n//2:cx+n//2]
-            #print(tmptmp.shape, file=sys.stderr)
-        else:
-            raise Exception("zero padding not completed yet")
-            # # is this part necessary???
-            # #tmptmp = t
-            # tmptmp = np.zeros((n, n))
-            # #tmptmp[3:-3,:] = t[:,cy-n//2:cy+n//2]
-            # tmptmp[4:-8, :] = img[:, cy-n//2:cy+n//2]
-
-        #if i == 0:
-        #    import matplotlib.pyplot as plt
-        #    plt.imshow(tmptmp, vmin=np.min(img), vmax=np.max(img))
-        #    plt.savefig("ttttt.png")
-        #    return
-
-        tmptmp = np.rot90(tmptmp, axes=(1,0)) #equivalent to np.flipud(tmptmp).T
-        if not np.sum(tmptmp) > 0.:
-            mask.append(i)
-        data[i] = np.fft.fftshift(tmptmp)
-
-    if len(mask) > 0:
-        print("Removing the dark frames:", mask, file=sys.stderr)
-        data = np.delete(data, mask, axis=0)
-        param.points = np.delete(param.points, mask, axis=1)
-        param.nz = param.nz - len(mask)
-    data[data < threshold] = 0.
-    data = np.sqrt(data)
-    # data array got
-    print('array size:', np.shape(data))
-
     # create a folder
     try:
         os.mkdir(param.working_directory + '/h5_data/')
     except FileExistsError:
         pass
 
-    file_path = param.working_directory + '/h5_data/scan_' + str(scan_num) + '.h5'
-    with h5py.File(file_path, 'w') as hf:
-        dset = hf.create_dataset('diffamp', data=data)
-        dset = hf.create_dataset('points', data=param.points)
-        dset = hf.create_dataset('x_range', data=param.x_range)
-        dset = hf.create_dataset('y_range', data=param.y_range)
-        dset = hf.create_dataset('dr_x', data=param.dr_x)
-        dset = hf.create_dataset('dr_y', data=param.dr_y)
-        dset = hf.create_dataset('z_m', data=det_distance_m)
-        dset = hf.create_dataset('lambda_nm', data=lambda_nm)
-        dset = hf.create_dataset('ccd_pixel_um', data=det_pixel_um)
-        dset = hf.create_dataset('angle', data=angle)
-        dset = hf.create_dataset('ic', data=ic)
-        dset = hf.create_dataset('x_pixel_m', data=x_pixel_m)
-        dset = hf.create_dataset('y_pixel_m', data=y_pixel_m)
-        dset = hf.create_dataset('x_depth_field_m', data=x_depth_of_field_m)
-        dset = hf.create_dataset('y_depth_field_m', data=y_depth_of_field_m)
+    # reuse the previous result if the crop settings are unchanged
+    crop_key = get_crop_key(param, 'HXN', scan_num, param.mds_table.shape[0], n, nn, cx, cy, threshold, bad_pixels,
+                            zero_out)
+    file_path = get_scan_file_path(param, scan_num, crop_key)
+    if not load_cached_scan(param, file_path, crop_key):
+        metadata = dict(x_range=param.x_range,
+                        y_range=param.y_range,
+                        dr_x=param.dr_x,
+                        dr_y=param.dr_y,
+                        z_m=det_distance_m,
+                        lambda_nm=lambda_nm,
+                        ccd_pixel_um=det_pixel_um,
+                        angle=angle,
+                        ic=ic,
+                        x_pixel_m=x_pixel_m,
+                        y_pixel_m=y_pixel_m,
+                        x_depth_field_m=x_depth_of_field_m,
+                        y_depth_field_m=y_depth_of_field_m)
+        if param.crop_mpi_processes > 1:
+            try:
+                from nsls2ptycho.core.mpi_crop import launch_mpi_crop
+            except ModuleNotFoundError:
+                # for test purpose
+                from mpi_crop import launch_mpi_crop
+            launch_mpi_crop(param, file_path, n, nn, cx, cy, threshold, bad_pixels, zero_out, metadata, crop_key)
+        else:
+            _crop_to_h5(db, param, file_path, n, nn, cx, cy, threshold, bad_pixels, zero_out, metadata, crop_key)
+        prune_cached_scans(param, scan_num)
 
     # symlink so ptycho can find it
-    try:
-        symlink_path = param.working_directory + '/scan_' + str(scan_num) + '.h5'
-        os.symlink(file_path, symlink_path)
-    except FileExistsError:
-        os.remove(symlink_path)
-        os.symlink(file_path, symlink_path)
+    link_scan_file(file_path, param.working_directory, scan_num)
 
 
-def get_single_image(db, frame_num, mds_table):
+def get_single_image(db, frame_num, mds_table, param=None):
     length = (mds_table.shape)[0]
     if frame_num >= length:
         message = "[ERROR] The {0}-th frame doesn't exist. "
         message += "Available frames for the chosen scan: [0, {1}]."
         raise ValueError(message.format(frame_num, length-1))
 
+    # use the raw-frame cache if the scan has been read before
+    cache = get_raw_frame_cache(param) if param is not None else None
+    if cache is not None:
+        frames = cache.get(_raw_frame_key(mds_table))
+        if frames is not None and frames.shape[0] == length:
+            return np.array(frames[frame_num])
+
     img = db.reg.retrieve(mds_table.iat[frame_num])[0]
     return img
 
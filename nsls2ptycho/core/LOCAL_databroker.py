@@ -0,0 +1,370 @@
+'''
+A file-based stand-in for a beamline's databroker, for working offline (ex: to
+benchmark or regression-test the ingest and crop pipeline at production data sizes).
+
+The "database" is a directory holding one subdirectory per scan:
+
+    <root>/scan_<N>/metadata.json    scan_type, xray_energy_kev, x_range, y_range, dr_x, dr_y,
+                                     angle, ccd_pixel_um, motors (the [x, y] position columns),
+                                     ic_name (the scaler column, optional), z_m (optional)
+    <root>/scan_<N>/positions.csv    one row per frame; a header row names the columns (the
+                                     motors and scalers); alternatively a "positions" dict of
+                                     columns in metadata.json
+    <root>/scan_<N>/<det_name>.npy   the frames of shape (N, ny, nx), or
+    <root>/scan_<N>/<det_name>.h5    with the frames in the dataset "data", or
+    <root>/scan_<N>/<det_name>/      one frame per .npy/.tif/.tiff file, in sorted order
+
+The root is given by "local_data_dir" in ~/.ptycho_gui/nsls2ptycho.json (which also sets
+"beamline_name": "LOCAL"), or by the NSLS2PTYCHO_LOCAL_DATA environment variable.
+make_scan() writes a scan in this layout.
+'''
+import csv
+import glob
+import json
+import numpy as np
+import sys, os
+import h5py
+try:
+    from nsls2ptycho.core.ptycho_preprocess import iter_blocks, preprocess_frames, array_ensure_positive_elements
+    from nsls2ptycho.core.ptycho_h5 import (DiffampWriter, get_diffamp_dtype, get_h5_metadata, get_crop_key,
+                                            get_scan_file_path, load_cached_scan, prune_cached_scans, link_scan_file)
+except ModuleNotFoundError:
+    # for test purpose
+    from ptycho_preprocess import iter_blocks, preprocess_frames, array_ensure_positive_elements
+    from ptycho_h5 import (DiffampWriter, get_diffamp_dtype, get_h5_metadata, get_crop_key,
+                           get_scan_file_path, load_cached_scan, prune_cached_scans, link_scan_file)
+
+
+# ***************************** "Public API" *****************************
+# The following functions must exist in nsls2ptycho/core/*_databroker.py,
+# but the function signatures do not need to agree across modules
+# (obviously, it is impossible for all beamlines to have the same setup).
+#   - load_metadata
+#   - save_data
+#   - get_single_image
+#   - get_detector_names
+# Other function must not be imported in the GUI.
+# ************************************************************************
+
+
+class LocalScan(object):
+    '''
+    A scan directory; mimics the parts of a databroker header used by the GUI.
+    '''
+    def __init__(self, scan_dir):
+        self.scan_dir = scan_dir
+        with open(os.path.join(scan_dir, 'metadata.json'), 'r') as f:
+            self.start = json.load(f)
+        self.stop = {'exit_status': 'success'}
+
+    def positions(self):
+        '''
+        Return the per-frame columns (motors and scalers) as a dict of arrays.
+        '''
+        csv_path = os.path.join(self.scan_dir, 'positions.csv')
+        if os.path.isfile(csv_path):
+            with open(csv_path, 'r', newline='') as f:
+                reader = csv.reader(f)
+                names = [name.strip() for name in next(reader)]
+                rows = np.array([[float(v) for v in row] for row in reader if len(row) > 0])
+            rows = rows.reshape(-1, len(names))
+            return {name: rows[:, i] for i, name in enumerate(names)}
+        return {name: np.asarray(values, dtype=np.float64) for name, values in self.start['positions'].items()}
+
+
+class LocalDB(object):
+    '''
+    A directory of scans, indexed like a Broker: db[scan_num].
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def __getitem__(self, scan_num):
+        scan_dir = os.path.join(self.root, 'scan_' + str(scan_num))
+        if not os.path.isdir(scan_dir):
+            raise ValueError("[ERROR] scan {} is not found in {}".format(scan_num, self.root))
+        return LocalScan(scan_dir)
+
+
+class LocalFrames(object):
+    '''
+    The frames of one detector in a scan (the counterpart of HXN's mds_table). Frames
+    are read on demand: .npy stacks are memory-mapped, HDF5 datasets are sliced.
+    '''
+    def __init__(self, scan_dir, det_name):
+        self.scan_dir = scan_dir
+        self.det_name = det_name
+        base = os.path.join(scan_dir, det_name)
+        self._files = None
+        if os.path.isfile(base + '.npy'):
+            self._kind = 'npy'
+            self.shape = np.load(base + '.npy', mmap_mode='r').shape[:1]
+        elif os.path.isfile(base + '.h5'):
+            self._kind = 'h5'
+            with h5py.File(base + '.h5', 'r') as f:
+                self.shape = f['data'].shape[:1]
+        elif os.path.isdir(base):
+            self._kind = 'files'
+            self._files = sorted(glob.glob(os.path.join(base, '*.npy')) + glob.glob(os.path.join(base, '*.tif'))
+                                 + glob.glob(os.path.join(base, '*.tiff')))
+            self.shape = (len(self._files),)
+        else:
+            raise ValueError("[ERROR] no frames of {} in {}".format(det_name, scan_dir))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_file(self, path):
+        if path.endswith('.npy'):
+            return np.load(path)
+        from PIL import Image
+        with Image.open(path) as img:
+            return np.array(img)
+
+    def __getitem__(self, i):
+        base = os.path.join(self.scan_dir, self.det_name)
+        if self._kind == 'npy':
+            return np.array(np.load(base + '.npy', mmap_mode='r')[i])
+        elif self._kind == 'h5':
+            with h5py.File(base + '.h5', 'r') as f:
+                return f['data'][i]
+        return self._read_file(self._files[i])
+
+    def iter_frames(self, start=0, stop=None):
+        '''
+        Yield the frames [start, stop) in order, keeping the file open.
+        '''
+        if stop is None:
+            stop = len(self)
+        base = os.path.join(self.scan_dir, self.det_name)
+        if self._kind == 'npy':
+            frames = np.load(base + '.npy', mmap_mode='r')
+            for i in range(start, stop):
+                yield frames[i]
+        elif self._kind == 'h5':
+            with h5py.File(base + '.h5', 'r') as f:
+                dset = f['data']
+                for i in range(start, stop):
+                    yield dset[i]
+        else:
+            for i in range(start, stop):
+                yield self._read_file(self._files[i])
+
+
+def _get_root():
+    root = os.environ.get('NSLS2PTYCHO_LOCAL_DATA')
+    config_path = os.path.expanduser("~") + "/.ptycho_gui/nsls2ptycho.json"
+    if root is None and os.path.isfile(config_path):
+        with open(config_path, 'r') as f:
+            root = json.load(f).get('local_data_dir')
+    return root
+
+
+local_root = _get_root()
+if local_root is None:
+    print("local_data_dir not set. Unable to access the local data.", file=sys.stderr)
+    local_db = None
+else:
+    local_db = LocalDB(local_root)
+
+
+def load_metadata(db, scan_num:int, det_name:str):
+    '''
+    Get all metadata for the given scan number and detector name
+
+    Parameters:
+        - db:
+            a LocalDB instance
+        - scan_num: int
+            the scan number
+        - det_name: str
+            the detector name
+
+    Return:
+        A dictionary that holds the metadata (except for those directly related to the image)
+    '''
+    header = db[scan_num]
+    start = header.start
+    columns = header.positions()
+    scan_motors = start['motors']
+    frames = LocalFrames(header.scan_dir, det_name)
+    nz = len(frames)
+
+    points = np.zeros((2, nz))
+    points[0] = columns[scan_motors[0]][:nz]
+    points[1] = columns[scan_motors[1]][:nz]
+
+    ic_name = start.get('ic_name')
+    if ic_name is not None:
+        ic = np.array(columns[ic_name][:nz], dtype=np.float64)
+        array_ensure_positive_elements(ic, name="scaler")
+    else:
+        ic = np.ones(nz)
+
+    # get nx and ny by looking at the first image
+    nx, ny = frames[0].shape
+
+    metadata = dict()
+    metadata['xray_energy_kev'] = start['xray_energy_kev']
+    metadata['scan_type'] = start.get('scan_type', 'local')
+    metadata['dr_x'] = start.get('dr_x', 0.)
+    metadata['dr_y'] = start.get('dr_y', 0.)
+    metadata['x_range'] = start.get('x_range', float(np.ptp(points[0])))
+    metadata['y_range'] = start.get('y_range', float(np.ptp(points[1])))
+    metadata['points'] = points
+    metadata['angle'] = start.get('angle', 0.)
+    metadata['ic'] = ic
+    metadata['ccd_pixel_um'] = start.get('ccd_pixel_um', 55.)
+    metadata['nz'] = nz
+    metadata['nx'] = nx
+    metadata['ny'] = ny
+    metadata['mds_table'] = frames
+    if 'z_m' in start:
+        metadata['z_m'] = start['z_m']
+
+    return metadata
+
+
+def save_data(db, param, scan_num:int, n:int, nn:int, cx:int, cy:int, threshold=1., bad_pixels=None, zero_out=None):
+    '''
+    Save metadata and diffamp for the given scan number to a HDF5 file.
+
+    Parameters:
+        - db:
+            a LocalDB instance
+        - param: Param
+            a Param instance containing the metadata and other information from the GUI
+        - scan_num: int
+            the scan number
+        - n: int
+            the x dimension of the ROI window (=nx_prb)
+        - nn: int
+            the y dimension of the ROI window (=ny_prb)
+        - cx: int
+            x index of the center of mass
+        - cy: int
+            y index of the center of mass
+        - threshold: float, optional
+            the threshold of raw data, below which the data is removed
+        - bad_pixels: list of two lists, optional
+            the data structure is [[x1, x2, ...], [y1, y2, ...]]. If given, they will be removed from the images.
+        - zero_out: list of tuples, optional
+            zero out the given rois [(x0, y0, w0, h0), (x1, y1, w1, h1), ...]
+
+    Notes:
+        1. the detector distance is assumed existent as param.z_m
+    '''
+    try:
+        os.mkdir(param.working_directory + '/h5_data/')
+    except FileExistsError:
+        pass
+
+    # reuse the previous result if the crop settings are unchanged
+    crop_key = get_crop_key(param, 'LOCAL', scan_num, param.mds_table.shape[0], n, nn, cx, cy, threshold, bad_pixels,
+                            zero_out, root=db.root)
+    file_path = get_scan_file_path(param, scan_num, crop_key)
+    if not load_cached_scan(param, file_path, crop_key):
+        metadata = get_h5_metadata(param, n, nn)
+        metadata['ic'] = param.ic
+        ic = param.ic
+        mask = []
+        with DiffampWriter(file_path, (n//2*2, nn//2*2),
+                           dtype=get_diffamp_dtype(param.h5_dtype, param.precision),
+                           compression=param.h5_compression, chunk_frames=param.h5_chunk_frames) as writer:
+            start = 0
+            for block in iter_blocks(param.mds_table.iter_frames(0, param.nz)):
+                stop = start + block.shape[0]
+                data, dark = preprocess_frames(block, n, nn, cx, cy, scale=ic[0]/ic[start:stop],
+                                               threshold=threshold, bad_pixels=bad_pixels, zero_out=zero_out)
+                writer.append(data[~dark], param.points[:, start:stop][:, ~dark])
+                mask.extend((np.flatnonzero(dark) + start).tolist())
+                start = stop
+
+            if len(mask) > 0:
+                print("Removing the dark frames:", mask, file=sys.stderr)
+                param.points = np.delete(param.points, mask, axis=1)
+                param.nz = param.nz - len(mask)
+            print('array size:', writer.shape)
+
+            writer.write_metadata(**metadata)
+            writer.write_attrs(crop_key=crop_key)
+        prune_cached_scans(param, scan_num)
+
+    # symlink so ptycho can find it
+    link_scan_file(file_path, param.working_directory, scan_num)
+
+
+def get_single_image(db, frame_num, mds_table, param=None):
+    length = (mds_table.shape)[0]
+    if frame_num >= length:
+        message = "[ERROR] The {0}-th frame doesn't exist. "
+        message += "Available frames for the chosen scan: [0, {1}]."
+        raise ValueError(message.format(frame_num, length-1))
+    return mds_table[frame_num]
+
+
+def get_detector_names(db, scan_num:int):
+    '''
+    Returns
+    -------
+        list: detectors (frame files or directories) found in the scan directory
+    '''
+    scan_dir = db[scan_num].scan_dir
+    names = set()
+    for entry in os.listdir(scan_dir):
+        name, ext = os.path.splitext(entry)
+        if ext in ('.npy', '.h5') or (ext == '' and os.path.isdir(os.path.join(scan_dir, entry))):
+            names.add(name)
+    return sorted(names)
+
+
+def make_scan(root, scan_num:int, frames, points, ic=None, det_name='merlin1', fmt='npy', **start):
+    '''
+    Write a scan in the layout read by this module.
+
+    Parameters:
+        - frames: np.ndarray or iterable
+            the raw frames; an iterable of 2D frames is written frame by frame (fmt='files')
+            or streamed (fmt='h5'), so production-sized scans need not fit in memory
+        - points: np.ndarray of shape (2, N)
+        - ic: np.ndarray of shape (N,), optional
+        - fmt: str
+            'npy', 'h5' or 'files'
+        - start: the rest of metadata.json (xray_energy_kev, x_range, ...)
+    '''
+    scan_dir = os.path.join(root, 'scan_' + str(scan_num))
+    os.makedirs(scan_dir, exist_ok=True)
+    num_frames = points.shape[1]
+
+    columns = {'x': points[0], 'y': points[1]}
+    if ic is not None:
+        columns['ic'] = ic
+        start.setdefault('ic_name', 'ic')
+    start.setdefault('motors', ['x', 'y'])
+    start.setdefault('xray_energy_kev', 10.)
+    with open(os.path.join(scan_dir, 'metadata.json'), 'w') as f:
+        json.dump(start, f, indent=2)
+    with open(os.path.join(scan_dir, 'positions.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns.keys()))
+        writer.writerows(zip(*[col.tolist() for col in columns.values()]))
+
+    base = os.path.join(scan_dir, det_name)
+    if fmt == 'npy':
+        np.save(base + '.npy', np.asarray(frames))
+    elif fmt == 'h5':
+        with h5py.File(base + '.h5', 'w') as f:
+            dset = None
+            for i, frame in enumerate(frames):
+                if dset is None:
+                    dset = f.create_dataset('data', shape=(num_frames,)+frame.shape, dtype=frame.dtype,
+                                            chunks=(1,)+frame.shape)
+                dset[i] = frame
+    elif fmt == 'files':
+        os.makedirs(base, exist_ok=True)
+        for i, frame in enumerate(frames):
+            np.save(os.path.join(base, 'frame_{:06d}.npy'.format(i)), frame)
+    else:
+        raise ValueError("Unknown format: {}".format(fmt))
+    return scan_dir
+
@@ -1,6 +1,7 @@
 import json
 import os, sys
 import platform
+import threading
 
 
 # ***************************** "Public API" *****************************
@@ -12,62 +13,126 @@ import platform
 #   - get_single_image
 #   - get_detector_names
 # Other function must not be imported in the GUI.
+#
+# The backend module must also hold its Broker instance as "db" or as
+# "<beamline name in lower case>_db" (ex: hxn_db).
+#
+# The built-in backends are registered below. Other packages add theirs through the
+# "nsls2ptycho.beamlines" entry point group, ex: in their setup.py
+#     entry_points={'nsls2ptycho.beamlines': ['XYZ = mypackage.XYZ_databroker']}
+# (a built-in name cannot be overridden this way).
+# A backend is imported (and so connected to its database) only when a databroker
+# function is first called, not when this module is imported.
 # ************************************************************************
 
-load_metadata = None
-save_data = None
-get_single_image = None
-get_detector_names = None
-db = None
+_registry = {'HXN': 'nsls2ptycho.core.HXN_databroker',
+             'CSX': 'nsls2ptycho.core.CSX_databroker',
+             'LOCAL': 'nsls2ptycho.core.LOCAL_databroker'} # offline stand-in reading a directory
+_backend = None
+_backend_lock = threading.Lock()
+_entry_points_loaded = False
 
 
-def _load_HXN():
-    import nsls2ptycho.core.HXN_databroker as hxn_databroker
-    global load_metadata, save_data, get_single_image, get_detector_names, db
-    load_metadata = hxn_databroker.load_metadata
-    save_data = hxn_databroker.save_data
-    get_single_image = hxn_databroker.get_single_image
-    get_detector_names = hxn_databroker.get_detector_names
-    db = hxn_databroker.hxn_db
-    print("HXN's Databroker is enabled.", file=sys.stderr)
+def register_beamline(name:str, module:str):
+    '''
+    Register the backend module (its import path) for the given beamline name.
+    '''
+    _registry[name] = module
 
 
-def _load_CSX():
-    import nsls2ptycho.core.CSX_databroker as csx_databroker
-    global load_metadata, save_data, get_single_image, get_detector_names, db
-    load_metadata = csx_databroker.load_metadata
-    save_data = csx_databroker.save_data
-    get_single_image = csx_databroker.get_single_image
-    get_detector_names = csx_databroker.get_detector_names
-    db = csx_databroker.csx_db
-    print("CSX's Databroker is enabled.", file=sys.stderr)
+def _load_entry_points():
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    try:
+        from importlib.metadata import entry_points
+    except ImportError: # Python < 3.8
+        return
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group='nsls2ptycho.beamlines')
+    else:
+        eps = eps.get('nsls2ptycho.beamlines', [])
+    for ep in eps:
+        _registry.setdefault(ep.name, ep.value)
 
 
-try:
+def get_registered_beamlines():
+    _load_entry_points()
+    return sorted(_registry.keys())
+
+
+def _detect_beamline():
     hostname = platform.node()
     config_path = os.path.expanduser("~") + "/.ptycho_gui/nsls2ptycho.json"
 
     if hostname.startswith('xf03id'):
-        beamline_name = 'HXN'
+        return 'HXN'
     elif hostname.startswith('xf23id'):
-        beamline_name = 'CSX'
+        return 'CSX'
     elif os.path.isfile(config_path):
         with open(config_path, 'r') as f:
             beamline_config = json.load(f)
-            beamline_name = beamline_config['beamline_name']
-    else:
-        beamline_name = None
+            return beamline_config['beamline_name']
+    return None
+
+
+def get_backend():
+    '''
+    Import (once) and return the backend module of the detected beamline.
+    '''
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            return _backend
+        if beamline_name is None:
+            raise RuntimeError("[WARNING] Cannot detect the beamline name. Databroker is disabled.")
+        if beamline_name not in _registry:
+            _load_entry_points()
+        if beamline_name not in _registry:
+            raise RuntimeError("[ERROR] No databroker backend is registered for {}. Available: {}"
+                               .format(beamline_name, get_registered_beamlines()))
+        import importlib
+        try:
+            _backend = importlib.import_module(_registry[beamline_name])
+        except ImportError as ex:
+            raise RuntimeError("[WARNING] Databroker is not found and so disabled: {}".format(ex)) from ex
+        print("{}'s Databroker is enabled.".format(beamline_name), file=sys.stderr)
+        return _backend
+
+
+def get_db():
+    '''
+    Return the Broker instance of the detected beamline (connecting on first use).
+    '''
+    backend = get_backend()
+    if hasattr(backend, 'db'):
+        return backend.db
+    return getattr(backend, beamline_name.lower() + '_db')
 
-    if beamline_name == 'HXN':
-        _load_HXN()
-    elif beamline_name == 'CSX':
-        _load_CSX()
-    else:
-        raise RuntimeError("[WARNING] Cannot detect the beamline name. Databroker is disabled.")
-except ImportError:
-    print("[WARNING] Databroker is not found and so disabled.", file=sys.stderr)
-except RuntimeError as ex:
-    print(ex, file=sys.stderr)
 
+def load_metadata(*args, **kwargs):
+    return get_backend().load_metadata(*args, **kwargs)
+
+
+def save_data(*args, **kwargs):
+    return get_backend().save_data(*args, **kwargs)
+
+
+def get_single_image(*args, **kwargs):
+    return get_backend().get_single_image(*args, **kwargs)
+
+
+def get_detector_names(*args, **kwargs):
+    return get_backend().get_detector_names(*args, **kwargs)
+
+
+try:
+    beamline_name = _detect_beamline()
+except (OSError, ValueError, KeyError) as ex:
+    print("[WARNING] Cannot read the beamline config: {}".format(ex), file=sys.stderr)
+    beamline_name = None
+if beamline_name is None:
+    print("[WARNING] Cannot detect the beamline name. Databroker is disabled.", file=sys.stderr)
 
-del config_path, hostname, json, os, platform, sys
@@ -0,0 +1,200 @@
+'''
+Detector-health analysis: classify hot, dead and flickering pixels from the statistics
+of many frames instead of a single image.
+
+PixelStatistics accumulates per-pixel running statistics (mean, variance, zero count,
+saturation count) block by block, so all (or a sampled subset of) the frames of a scan
+can be streamed through it. classify_pixels() turns the statistics into boolean masks,
+which are persisted per detector under ~/.ptycho_gui/detector_masks/ to be reused for
+later scans (see save_mask() and load_mask()).
+'''
+import itertools
+import os
+import sys
+import numpy as np
+from scipy.ndimage import median_filter
+try:
+    from nsls2ptycho.core.ptycho_preprocess import iter_blocks
+except ModuleNotFoundError:
+    # for test purpose
+    from ptycho_preprocess import iter_blocks
+
+
+mask_dir = os.path.expanduser("~") + "/.ptycho_gui/detector_masks"
+mask_names = ['hot', 'dead', 'flicker']
+
+
+class PixelStatistics(object):
+    '''
+    Running per-pixel statistics of a stream of frames of shape (height, width).
+
+    Parameters:
+        - shape: tuple
+            the frame shape
+        - saturation: float, optional
+            the value at or above which a pixel counts as saturated; if None, the
+            maximum of the frame dtype is used for integer frames and saturation is
+            not counted for floating-point frames
+    '''
+    def __init__(self, shape, saturation=None):
+        self.shape = tuple(shape)
+        self.saturation = saturation
+        self.num_frames = 0
+        self.mean = np.zeros(self.shape)
+        self._m2 = np.zeros(self.shape)  # sum of squared deviations from the mean
+        self.zero_count = np.zeros(self.shape, dtype=np.int64)
+        self.saturation_count = np.zeros(self.shape, dtype=np.int64)
+
+    @property
+    def variance(self):
+        if self.num_frames < 2:
+            return np.zeros(self.shape)
+        return self._m2 / (self.num_frames - 1)
+
+    def update(self, frames):
+        '''
+        Add a block of frames of shape (N, height, width), merging its statistics into the
+        running ones (Chan et al.'s parallel algorithm, so no pass is made over old frames).
+        '''
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        k = frames.shape[0]
+        if k == 0:
+            return
+        if frames.shape[1:] != self.shape:
+            raise ValueError("frame shape {} does not match {}".format(frames.shape[1:], self.shape))
+
+        saturation = self.saturation
+        if saturation is None and np.issubdtype(frames.dtype, np.integer):
+            saturation = np.iinfo(frames.dtype).max
+        self.zero_count += np.count_nonzero(frames == 0, axis=0)
+        if saturation is not None:
+            self.saturation_count += np.count_nonzero(frames >= saturation, axis=0)
+
+        block = frames.astype(np.float64)
+        block_mean = block.mean(axis=0)
+        block -= block_mean
+        block_m2 = np.einsum('ijk,ijk->jk', block, block)
+
+        n = self.num_frames
+        total = n + k
+        delta = block_mean - self.mean
+        self.mean += delta * (k / total)
+        self._m2 += block_m2 + delta**2 * (n * k / total)
+        self.num_frames = total
+
+
+def classify_pixels(stats, hot_sigma=10., dead_fraction=0.99, saturation_fraction=0.5, flicker_factor=5.):
+    '''
+    Classify the pixels from their statistics. Each pixel is compared with the median of
+    its 3x3 neighborhood, so the bright, strongly varying center of the diffraction
+    patterns is not mistaken for bad pixels.
+
+    Parameters:
+        - stats: PixelStatistics
+        - hot_sigma: float
+            a pixel is hot if its mean exceeds the local median by this many local
+            standard deviations (frame to frame), or if it saturates in more than
+            saturation_fraction of the frames
+        - dead_fraction: float
+            a pixel is dead if it reads zero in at least this fraction of the frames
+            while its neighborhood does not
+        - flicker_factor: float
+            a pixel flickers if its variance-to-mean ratio exceeds the local median
+            ratio by this factor
+
+    Return:
+        a dict of boolean masks of the frame shape, keyed by mask_names
+    '''
+    if stats.num_frames == 0:
+        raise ValueError("no frames were analyzed")
+    mean = stats.mean
+    zero_fraction = stats.zero_count / stats.num_frames
+
+    # the local fluctuation level; +1 keeps empty (all-zero) areas from flagging single counts
+    noise = np.sqrt(median_filter(stats.variance, size=3, mode='nearest') + 1.)
+    hot = mean - median_filter(mean, size=3, mode='nearest') > hot_sigma * noise
+    hot |= stats.saturation_count > saturation_fraction * stats.num_frames
+
+    dead = (zero_fraction >= dead_fraction) & (median_filter(zero_fraction, size=3, mode='nearest') < dead_fraction)
+
+    flicker = np.zeros(stats.shape, dtype=bool)
+    if stats.num_frames > 1:
+        dispersion = np.divide(stats.variance, mean, out=np.zeros(stats.shape), where=mean > 0)
+        local = median_filter(dispersion, size=3, mode='nearest')
+        flicker = dispersion > flicker_factor * np.maximum(local, np.finfo(np.float64).eps)
+        flicker &= ~(hot | dead)
+
+    return {'hot': hot, 'dead': dead, 'flicker': flicker}
+
+
+def analyze_frames(frames, stride:int=1, saturation=None, **kwargs):
+    '''
+    Stream the 2D frames (an iterable) through PixelStatistics, keeping every stride-th
+    frame, and classify the pixels. The keyword arguments go to classify_pixels().
+
+    Return:
+        (masks, stats)
+    '''
+    stats = None
+    for block in iter_blocks(itertools.islice(frames, 0, None, stride)):
+        if stats is None:
+            stats = PixelStatistics(block.shape[1:], saturation)
+        stats.update(block)
+    if stats is None:
+        raise ValueError("no frames were analyzed")
+    return classify_pixels(stats, **kwargs), stats
+
+
+def get_bad_pixels(masks):
+    '''
+    Return the union of the masks as the [[x1, x2, ...], [y1, y2, ...]] (row, column)
+    lists taken by save_data().
+    '''
+    bad = np.zeros_like(masks[mask_names[0]])
+    for name in mask_names:
+        bad |= masks[name]
+    rows, cols = np.nonzero(bad)
+    return [rows.tolist(), cols.tolist()]
+
+
+def save_mask(det_name:str, masks, num_frames:int=0, directory=None):
+    '''
+    Save the masks of the given detector as <directory>/<det_name>.npz (by default in mask_dir).
+    '''
+    if directory is None:
+        directory = mask_dir
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, det_name + '.npz')
+    tmp_path = file_path + '.part.npz'
+    np.savez_compressed(tmp_path, num_frames=num_frames, **{name: masks[name] for name in mask_names})
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def load_mask(det_name:str, shape=None, directory=None):
+    '''
+    Load the masks saved for the given detector. Return None if there is none, or if
+    its frame shape differs from shape (when given).
+    '''
+    if directory is None:
+        directory = mask_dir
+    file_path = os.path.join(directory, det_name + '.npz')
+    if not os.path.isfile(file_path):
+        return None
+    try:
+        with np.load(file_path) as f:
+            masks = {name: f[name] for name in mask_names}
+    except (OSError, KeyError, ValueError) as ex:
+        print("[WARNING] Cannot read the detector mask {}: {}".format(file_path, ex), file=sys.stderr)
+        return None
+    if shape is not None and masks['hot'].shape != tuple(shape):
+        print("[WARNING] The detector mask of {} has shape {}, but the frames have shape {}. Ignored."
+              .format(det_name, masks['hot'].shape, tuple(shape)), file=sys.stderr)
+        return None
+    return masks
+
+
+def summarize(masks):
+    return ', '.join('{} {}'.format(np.count_nonzero(masks[name]), name) for name in mask_names)
@@ -0,0 +1,119 @@
+import glob
+import os
+import sys
+import numpy as np
+
+
+class RawFrameCache(object):
+    '''
+    An on-disk cache of uncropped detector frames.
+
+    Each scan is stored as one .npy file of shape (num_frames, ny, nx) in cache_dir and
+    read back with np.load(mmap_mode='r'), so later crops, bad-pixel passes and frame
+    views slice the frames straight from the page cache instead of going through
+    databroker and the file handlers again. The files are evicted in least-recently-used
+    order (tracked by their modification times) to keep the total size within budget bytes.
+    '''
+    def __init__(self, cache_dir, budget):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        '''
+        Return the cached frames as a read-only memmap, or None if not cached.
+        '''
+        path = self._path(key)
+        try:
+            frames = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return frames
+
+    def put(self, key, array):
+        '''
+        Store a whole array (ex: a calibration image) and return it as a read-only memmap.
+        If it cannot be written, the array itself is returned.
+        '''
+        path = self._path(key)
+        tmp_path = os.path.join(self.cache_dir, '.{}.{}.part.npy'.format(key, os.getpid()))
+        array = np.asarray(array)
+        try:
+            self.evict(array.nbytes)
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            print("[WARNING] Cannot write {} to the cache: {}".format(key, ex), file=sys.stderr)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return array
+        return np.load(path, mmap_mode='r')
+
+    def fill(self, key, frames, num_frames:int):
+        '''
+        Pass through an iterable of num_frames frames while spilling them to the cache.
+        The entry becomes visible only once all frames went through; if the iteration is
+        abandoned or fails, the partial file is removed. Scans larger than the budget are
+        not cached.
+        '''
+        path = self._path(key)
+        tmp_path = os.path.join(self.cache_dir, '.{}.{}.part'.format(key, os.getpid()))
+        out = None
+        try:
+            for i, frame in enumerate(frames):
+                if i == 0:
+                    size = num_frames * frame.nbytes
+                    if size <= self.budget:
+                        self.evict(size)
+                        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=frame.dtype,
+                                                        shape=(num_frames,)+frame.shape)
+                    else:
+                        print("[WARNING] The raw frames ({:.1f} GB) exceed the cache budget and are not cached."
+                              .format(size/2**30), file=sys.stderr)
+                if out is not None:
+                    out[i] = frame
+                yield frame
+            if out is not None:
+                assert i == num_frames - 1
+                out.flush()
+                del out
+                out = None
+                os.replace(tmp_path, path)
+        finally:
+            if out is not None:
+                del out
+                os.remove(tmp_path)
+
+    def evict(self, reserve:int=0):
+        '''
+        Remove the least recently used entries until reserve more bytes fit in the budget.
+        '''
+        entries = sorted(glob.glob(os.path.join(self.cache_dir, '*.npy')), key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total + reserve <= self.budget:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
+_caches = {}
+
+
+def get_raw_frame_cache(param):
+    '''
+    Return the raw-frame cache under param.working_directory, or None if it is turned off.
+    '''
+    if not param.raw_cache_flag:
+        return None
+    cache_dir = os.path.join(param.working_directory, '.raw_cache')
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = RawFrameCache(cache_dir, int(param.raw_cache_budget_gb * 2**30))
+    else:
+        cache.budget = int(param.raw_cache_budget_gb * 2**30)
+    return cache
@@ -0,0 +1,268 @@
+'''
+Incremental ingest of a scan in progress.
+
+LiveScanIngest consumes the (name, doc) pairs of a Bluesky document stream (start,
+descriptor, event and stop documents) and crops the frames as they arrive, appending
+them and their scan coordinates to a growing, chunked scan_N.h5 (in SWMR mode, so it
+can be inspected while the scan runs). When the stop document arrives the file is
+complete, so the reconstruction can be set up right after the scan finishes instead
+of re-reading the whole scan.
+
+DirectoryDocumentStream is a local stand-in for the live stream: it replays the
+documents stored in a directory (see DirectoryDocumentRecorder), optionally following
+the directory while another process is still writing to it.
+
+Usage:
+    python -m nsls2ptycho.core.live_ingest DOC_DIR CONFIG --roi N NN CX CY [--follow]
+'''
+import json
+import os
+import sys
+import time
+import numpy as np
+
+try:
+    from nsls2ptycho.core.ptycho_preprocess import block_size, preprocess_frames
+    from nsls2ptycho.core.ptycho_h5 import DiffampWriter, get_diffamp_dtype, get_h5_metadata, link_scan_file, to_json
+except ModuleNotFoundError:
+    # for test purpose
+    from ptycho_preprocess import block_size, preprocess_frames
+    from ptycho_h5 import DiffampWriter, get_diffamp_dtype, get_h5_metadata, link_scan_file, to_json
+
+
+class DirectoryDocumentStream(object):
+    '''
+    Replay the (name, doc) pairs stored one per line as JSON in directory/documents.jsonl.
+
+    With follow=True the file is followed like `tail -f` until a stop document is read,
+    or until no new document arrives within timeout seconds (None waits forever).
+    '''
+    def __init__(self, directory, follow=False, poll_interval=0.1, timeout=None):
+        self.directory = directory
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def __iter__(self):
+        path = os.path.join(self.directory, 'documents.jsonl')
+        while self.follow and not os.path.isfile(path):
+            time.sleep(self.poll_interval)
+
+        with open(path, 'r') as f:
+            last_read = time.monotonic()
+            buf = ''
+            while True:
+                line = f.readline()
+                if line.endswith('\n'):
+                    name, doc = json.loads(buf + line)
+                    buf = ''
+                    last_read = time.monotonic()
+                    yield name, doc
+                    if name == 'stop':
+                        return
+                else:
+                    buf += line  # a partially written line
+                    if not self.follow:
+                        return
+                    if self.timeout is not None and time.monotonic() - last_read > self.timeout:
+                        raise TimeoutError("No document arrived in {} seconds.".format(self.timeout))
+                    time.sleep(self.poll_interval)
+
+
+class DirectoryDocumentRecorder(object):
+    '''
+    Record a document stream into a directory for DirectoryDocumentStream, ex:
+        recorder = DirectoryDocumentRecorder(directory, 'merlin1')
+        for name, doc in header.documents(fill=True):
+            recorder(name, doc)
+    The detector images are stored as separate .npy files referenced by the events.
+    '''
+    def __init__(self, directory, det_name):
+        self.directory = directory
+        self.det_name = det_name
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(os.path.join(directory, 'documents.jsonl'), 'w')
+
+    def __call__(self, name, doc):
+        doc = dict(doc)
+        if name == 'event' and self.det_name in doc['data']:
+            filename = 'frame_{:06d}.npy'.format(doc['seq_num'])
+            np.save(os.path.join(self.directory, filename), np.squeeze(doc['data'][self.det_name]))
+            doc['data'] = dict(doc['data'])
+            doc['data'][self.det_name] = filename
+        self._file.write(json.dumps([name, doc], default=to_json) + '\n')
+        self._file.flush()
+        if name == 'stop':
+            self._file.close()
+
+
+class LiveScanIngest(object):
+    '''
+    Crop the frames of a scan as its event documents arrive and append them to
+    working_directory/h5_data/scan_N.h5.
+
+    Parameters:
+        - param: Param
+            a Param instance holding the experimental parameters (z_m, lambda_nm, ...)
+        - scan_num: int
+            the scan number
+        - det_name: str
+            the detector name, i.e., the key of the images in the event documents
+        - n, nn, cx, cy, threshold, bad_pixels, zero_out:
+            same as in save_data()
+        - x_name, y_name: str, optional
+            the keys of the scan coordinates; default to the first two 'motors' of the start document
+        - ic_name: str, optional
+            the key of the scaler used for normalization; defaults to the start document's
+            'ic_name', and no normalization if absent
+        - frame_loader: callable, optional
+            turn the detector value of an event into a 2D array; by default a str is taken as
+            a .npy file relative to base_dir, and anything else is converted by np.asarray
+    '''
+    def __init__(self, param, scan_num:int, det_name:str, n:int, nn:int, cx:int, cy:int,
+                 threshold=1., bad_pixels=None, zero_out=None,
+                 x_name=None, y_name=None, ic_name=None, frame_loader=None, base_dir=''):
+        self.param = param
+        self.scan_num = scan_num
+        self.det_name = det_name
+        self.crop_args = (n, nn, cx, cy)
+        self.crop_kwargs = dict(threshold=threshold, bad_pixels=bad_pixels, zero_out=zero_out)
+        self.x_name = x_name
+        self.y_name = y_name
+        self.ic_name = ic_name
+        self.frame_loader = frame_loader
+        self.base_dir = base_dir
+        self.file_path = param.working_directory + '/h5_data/scan_' + str(scan_num) + '.h5'
+
+        self._writer = None
+        self._ic0 = None
+        self._last_ic = None
+        self._frames = []
+        self._points = []
+        self._scale = []
+        self.num_events = 0
+        self.num_dark = 0
+
+    def __call__(self, name, doc):
+        if name == 'start':
+            motors = doc.get('motors', [])
+            if self.x_name is None:
+                self.x_name = motors[0]
+            if self.y_name is None:
+                self.y_name = motors[1]
+            if self.ic_name is None:
+                self.ic_name = doc.get('ic_name')
+        elif name == 'event':
+            self._on_event(doc)
+        elif name == 'stop':
+            self._flush()
+            self.close()
+            print("[LIVE] scan {} complete: {} frames ingested, {} dark frames removed.".format(
+                  self.scan_num, self.num_events - self.num_dark, self.num_dark))
+
+    def _load_frame(self, value):
+        if self.frame_loader is not None:
+            return self.frame_loader(value)
+        if isinstance(value, str):
+            return np.load(os.path.join(self.base_dir, value))
+        return np.asarray(value)
+
+    def _on_event(self, doc):
+        data = doc['data']
+        if self.det_name not in data:
+            return
+        self._frames.append(np.squeeze(self._load_frame(data[self.det_name])))
+        self._points.append((data[self.x_name], data[self.y_name]))
+
+        # normalize to the first frame; a nonpositive reading (dropped scaler counts) is replaced
+        # by the latest valid one, as the following readings are not yet known
+        if self.ic_name is not None:
+            ic = float(data[self.ic_name])
+            if ic > 0:
+                self._last_ic = ic
+            elif self._last_ic is not None:
+                ic = self._last_ic
+            if self._ic0 is None and ic > 0:
+                self._ic0 = ic
+            self._scale.append(self._ic0 / ic if (self._ic0 is not None and ic > 0) else 1.)
+        self.num_events += 1
+
+        if len(self._frames) >= block_size:
+            self._flush()
+
+    def _open_writer(self):
+        p = self.param
+        n, nn = self.crop_args[:2]
+        try:
+            os.mkdir(p.working_directory + '/h5_data/')
+        except FileExistsError:
+            pass
+        writer = DiffampWriter(self.file_path, (n//2*2, nn//2*2),
+                               dtype=get_diffamp_dtype(p.h5_dtype, p.precision),
+                               compression=p.h5_compression, chunk_frames=p.h5_chunk_frames, swmr=True)
+        writer.write_metadata(**get_h5_metadata(p, n, nn))
+        link_scan_file(self.file_path, p.working_directory, self.scan_num)
+        return writer
+
+    def _flush(self):
+        if len(self._frames) == 0:
+            return
+        if self._writer is None:
+            self._writer = self._open_writer()
+        scale = self._scale if self.ic_name is not None else None
+        diffamp, dark = preprocess_frames(np.asarray(self._frames), *self.crop_args, scale=scale, **self.crop_kwargs)
+        points = np.asarray(self._points, dtype=np.float64).T
+        self._writer.append(diffamp[~dark], points[:, ~dark])
+        self.num_dark += int(np.count_nonzero(dark))
+        self._frames, self._points, self._scale = [], [], []
+
+    def close(self, discard=False):
+        if self._writer is not None:
+            self._writer.close(discard=discard)
+            self._writer = None
+
+
+def ingest(stream, ingestor):
+    '''
+    Feed a document stream to the ingestor; the partial file is removed if anything goes wrong.
+    '''
+    try:
+        for name, doc in stream:
+            ingestor(name, doc)
+    except BaseException:
+        ingestor.close(discard=True)
+        raise
+
+
+def main():
+    import argparse
+    from nsls2ptycho.core.ptycho_param import Param
+    from nsls2ptycho.core.ptycho.utils import parse_config
+
+    parser = argparse.ArgumentParser(description="Crop the frames of a (live or recorded) scan as they arrive.")
+    parser.add_argument('doc_dir', help="directory holding documents.jsonl and the frames")
+    parser.add_argument('config', help="GUI config file providing the experimental parameters")
+    parser.add_argument('--roi', nargs=4, type=int, required=True, metavar=('N', 'NN', 'CX', 'CY'))
+    parser.add_argument('--threshold', type=float, default=1.)
+    parser.add_argument('--scan-num', type=int, default=None, help="default: scan_id of the start document")
+    parser.add_argument('--det-name', default=None, help="default: detectorkind in the config")
+    parser.add_argument('--ic-name', default=None)
+    parser.add_argument('--follow', action='store_true', help="follow a scan that is still being written")
+    parser.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args()
+
+    param = parse_config(args.config, Param())
+    stream = iter(DirectoryDocumentStream(args.doc_dir, follow=args.follow, timeout=args.timeout))
+    name, start_doc = next(stream)
+    assert name == 'start', "the first document must be a start document"
+    scan_num = args.scan_num if args.scan_num is not None else start_doc['scan_id']
+    det_name = args.det_name if args.det_name is not None else param.detectorkind
+
+    ingestor = LiveScanIngest(param, scan_num, det_name, *args.roi, threshold=args.threshold,
+                              ic_name=args.ic_name, base_dir=args.doc_dir)
+    ingestor(name, start_doc)
+    ingest(stream, ingestor)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
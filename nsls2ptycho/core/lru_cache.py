@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    '''
+    A dict-like cache bounded by the number of entries and, optionally, by their total
+    size in bytes. When a bound is exceeded, the least recently used entries are evicted.
+
+    Lookups (get(), [], in) count as hits or misses; iterating over the keys does not,
+    and does not change the LRU order.
+
+    Parameters:
+        - max_items: int
+            the maximal number of entries
+        - max_bytes: int, optional
+            the maximal total size of the entries; sizes are given by sizeof(value),
+            by default the value's nbytes (0 for objects without it, ex: lazy readers)
+        - name: str, optional
+            used in the stats summary
+        - on_remove: callable, optional
+            called with the key of every entry that is evicted or deleted (ex: to keep an index in
+            sync), with the cache's lock held
+    '''
+    def __init__(self, max_items:int, max_bytes:int=None, sizeof=None, name='cache', on_remove=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.name = name
+        self.on_remove = on_remove
+        self._sizeof = sizeof if sizeof is not None else (lambda value: getattr(value, 'nbytes', 0))
+        self._data = OrderedDict()  # key -> (value, size)
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                raise KeyError(key)
+            return self.get(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            size = self._sizeof(value)
+            self._data[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.nbytes -= self._data.pop(key)[1]
+            if self.on_remove is not None:
+                self.on_remove(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    @property
+    def lock(self):
+        '''
+        The (reentrant) lock held by every operation on the cache, including the calls to
+        on_remove. Hold it to update a structure kept in sync with the cache atomically.
+        '''
+        return self._lock
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        # a snapshot, from the least to the most recently used
+        with self._lock:
+            return iter(list(self._data.keys()))
+
+    def keys(self):
+        return list(self)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._data.keys())
+            self._data.clear()
+            self.nbytes = 0
+            if self.on_remove is not None:
+                for key in keys:
+                    self.on_remove(key)
+
+    def _evict(self):
+        # always keep the newest entry, even if it alone exceeds max_bytes
+        while len(self._data) > 1 and (len(self._data) > self.max_items
+                                       or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key, (_, size) = self._data.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+            if self.on_remove is not None:
+                self.on_remove(key)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'items': len(self._data), 'nbytes': self.nbytes}
+
+    def __repr__(self):
+        return "{}: {} items ({:.1f} MB), {} hits, {} misses, {} evictions".format(
+               self.name, len(self._data), self.nbytes/2**20, self.hits, self.misses, self.evictions)
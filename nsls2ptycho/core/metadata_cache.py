@@ -0,0 +1,140 @@
+'''
+An on-disk cache of the results of load_metadata(), so that loading a scan again (ex:
+when a batch is re-run) does not query the database at all.
+
+The entries live in an SQLite file keyed by (beamline, scan id, detector): the scalar
+fields are stored as JSON, the arrays (points, ic, ...) as .npy blobs and anything
+else (ex: HXN's mds_table) pickled. The pickled objects are tagged with the versions
+of Python, numpy and pandas that wrote them and are only read back by the same ones;
+any other entry is a cache miss. Only scans that have finished (with a stop document)
+are stored, since the metadata of a scan in progress keeps changing.
+'''
+import io
+import json
+import os
+import pickle
+import sqlite3
+import sys
+from contextlib import closing
+import numpy as np
+
+
+cache_path = os.path.expanduser("~") + "/.ptycho_gui/metadata_cache.sqlite"
+
+# bump when the content of the metadata changes, to invalidate old entries
+cache_version = 2
+
+_objects_tag = None
+
+
+def _connect(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a new connection per call, as load_metadata() runs in several threads
+    conn = sqlite3.connect(path, timeout=10.)
+    conn.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                        beamline TEXT, scan_id INTEGER, det_name TEXT, version INTEGER,
+                        scalars TEXT, arrays BLOB, objects BLOB,
+                        PRIMARY KEY (beamline, scan_id, det_name))''')
+    return conn
+
+
+def _get_objects_tag():
+    global _objects_tag
+    if _objects_tag is None:
+        versions = ['python {}.{}'.format(*sys.version_info[:2]), 'numpy ' + np.__version__]
+        try:
+            import pandas
+            versions.append('pandas ' + pandas.__version__)
+        except ImportError:
+            pass
+        _objects_tag = ', '.join(versions).encode('utf-8')
+    return _objects_tag
+
+
+def _encode(metadata):
+    scalars, arrays, objects = {}, {}, {}
+    for key, value in metadata.items():
+        if isinstance(value, np.ndarray):
+            arrays[key] = value
+        elif isinstance(value, np.generic):
+            scalars[key] = value.item()
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            scalars[key] = value
+        else:
+            objects[key] = value
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    objects = _get_objects_tag() + b'\0' + pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL)
+    return json.dumps(scalars), buf.getvalue(), objects
+
+
+def _decode(scalars, arrays, objects):
+    # return None if the objects were pickled by other versions of the libraries
+    tag, _, objects = objects.partition(b'\0')
+    if tag != _get_objects_tag():
+        return None
+    metadata = json.loads(scalars)
+    with np.load(io.BytesIO(arrays)) as f:
+        for key in f.files:
+            metadata[key] = f[key]
+    metadata.update(pickle.loads(objects))
+    return metadata
+
+
+def get(beamline:str, scan_id:int, det_name:str=''):
+    '''
+    Return the cached metadata, or None. Relative scan ids (<= 0) are never cached.
+    '''
+    if cache_path is None or scan_id <= 0 or not os.path.isfile(cache_path):
+        return None
+    try:
+        with closing(_connect(cache_path)) as conn:
+            row = conn.execute('SELECT scalars, arrays, objects FROM metadata '
+                               'WHERE beamline=? AND scan_id=? AND det_name=? AND version=?',
+                               (beamline, int(scan_id), det_name, cache_version)).fetchone()
+    except Exception as ex:
+        # a broken cache should never prevent loading from the database
+        print("[WARNING] Cannot read the metadata cache: {}".format(ex), file=sys.stderr)
+        return None
+    if row is None:
+        return None
+    try:
+        return _decode(*row)
+    except Exception as ex:
+        # ex: a class that moved or changed between releases; the entry is rewritten after loading
+        print("[WARNING] Ignored an unreadable metadata cache entry for scan {}: {}".format(scan_id, ex),
+              file=sys.stderr)
+        return None
+
+
+def put(beamline:str, scan_id:int, det_name:str, metadata, closed:bool):
+    '''
+    Store the metadata of a scan. Open scans (closed=False) are not stored, and any
+    entry left from an earlier load is removed.
+    '''
+    if cache_path is None or scan_id <= 0:
+        return
+    try:
+        with closing(_connect(cache_path)) as conn, conn:
+            if closed:
+                conn.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (beamline, int(scan_id), det_name, cache_version, *_encode(metadata)))
+            else:
+                conn.execute('DELETE FROM metadata WHERE beamline=? AND scan_id=?', (beamline, int(scan_id)))
+    except Exception as ex:
+        print("[WARNING] Cannot write the metadata cache: {}".format(ex), file=sys.stderr)
+
+
+def clear(beamline:str=None, scan_id:int=None):
+    '''
+    Remove the entries of a scan, of a beamline, or all of them.
+    '''
+    if cache_path is None or not os.path.isfile(cache_path):
+        return
+    with closing(_connect(cache_path)) as conn, conn:
+        if beamline is None:
+            conn.execute('DELETE FROM metadata')
+        elif scan_id is None:
+            conn.execute('DELETE FROM metadata WHERE beamline=?', (beamline,))
+        else:
+            conn.execute('DELETE FROM metadata WHERE beamline=? AND scan_id=?', (beamline, int(scan_id)))
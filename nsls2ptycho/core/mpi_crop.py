@@ -0,0 +1,180 @@
+'''
+MPI-parallel crop of HXN scans.
+
+The frame range of the scan is split across the MPI ranks. Each rank retrieves and
+crops its own frames and writes them to a shard next to the output file; rank 0 then
+merges the shards, in rank order, into scan_N.h5. save_data() uses it when
+param.crop_mpi_processes > 1:
+
+    mpirun -n N python -m nsls2ptycho.core.mpi_crop JOB_FILE
+
+where JOB_FILE is a pickle of the arguments of the crop written by launch_mpi_crop(). It
+holds only plain values and numpy arrays (the datum IDs, scan coordinates, ic and the
+storage options), not the Param object. The same MPI machine file as for the
+reconstruction (param.mpi_file_path) is used if given. The job file and the shards are
+removed by the launcher however the run ends.
+'''
+import glob
+import os
+import pickle
+import subprocess
+import sys
+import numpy as np
+import h5py
+
+try:
+    from nsls2ptycho.core.utils import use_mpi_machinefile, set_flush_early
+    from nsls2ptycho.core.ptycho_h5 import DiffampWriter, get_diffamp_dtype
+    from nsls2ptycho.core.ptycho_preprocess import iter_blocks, preprocess_frames
+except ModuleNotFoundError:
+    # for test purpose
+    from utils import use_mpi_machinefile, set_flush_early
+    from ptycho_h5 import DiffampWriter, get_diffamp_dtype
+    from ptycho_preprocess import iter_blocks, preprocess_frames
+
+
+def launch_mpi_crop(param, file_path, n:int, nn:int, cx:int, cy:int, threshold, bad_pixels, zero_out,
+                    metadata, crop_key):
+    '''
+    Run the crop with mpirun and wait for it to finish. On success, param.points and
+    param.nz are updated with the frames kept in file_path (dark frames removed).
+    '''
+    job_path = os.path.join(os.path.dirname(file_path), '.' + os.path.basename(file_path) + '.mpi_job')
+    job = dict(file_path=file_path, crop_args=(n, nn, cx, cy),
+               crop_kwargs=dict(threshold=threshold, bad_pixels=bad_pixels, zero_out=zero_out),
+               metadata=metadata, crop_key=crop_key,
+               datum_ids=[param.mds_table.iat[i] for i in range(param.nz)],
+               points=np.asarray(param.points), ic=np.asarray(param.ic),
+               num_workers=param.crop_num_workers,
+               writer_kwargs=dict(dtype=get_diffamp_dtype(param.h5_dtype, param.precision).name,
+                                  compression=param.h5_compression, chunk_frames=param.h5_chunk_frames))
+
+    # "1" is just a placeholder to be overwritten soon
+    mpirun_command = ["mpirun", "-n", "1", "python", "-W", "ignore", "-m", "nsls2ptycho.core.mpi_crop"]
+    if param.mpi_file_path == '':
+        mpirun_command[2] = str(param.crop_mpi_processes)
+    else:
+        mpirun_command = use_mpi_machinefile(mpirun_command, param.mpi_file_path)
+    mpirun_command = set_flush_early(mpirun_command)
+    mpirun_command.append(job_path)
+
+    try:
+        with open(job_path, 'wb') as f:
+            pickle.dump(job, f)
+        with subprocess.Popen(mpirun_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              env=dict(os.environ, mpi_warn_on_fork='0')) as run_crop:
+            for line in run_crop.stdout:
+                print(line.decode('utf-8'), end='')
+        if run_crop.returncode != 0:
+            raise RuntimeError("The MPI crop exited with code {}.".format(run_crop.returncode))
+    finally:
+        # ranks killed by an abort leave their (partial) shards behind
+        for path in [job_path] + _leftover_paths(file_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    with h5py.File(file_path, 'r') as f:
+        param.points = f['points'][:]
+        param.nz = f['diffamp'].shape[0]
+
+
+def _shard_path(file_path, rank):
+    return os.path.join(os.path.dirname(file_path), '.{}.rank{}'.format(os.path.basename(file_path), rank))
+
+
+def _leftover_paths(file_path):
+    # the shards (see _shard_path), and the temporary files of the DiffampWriters writing
+    # the shards and merging them
+    dirname, basename = os.path.split(file_path)
+    dirname, escaped = glob.escape(dirname), glob.escape(basename)
+    return glob.glob(os.path.join(dirname, '.' + escaped + '.rank*')) + \
+           glob.glob(os.path.join(dirname, '..' + escaped + '.rank*.part')) + \
+           [os.path.join(os.path.dirname(file_path), '.' + basename + '.part')]
+
+
+def crop_shard(db, job, start:int, stop:int, shard_path):
+    '''
+    Crop the frames [start, stop) of the scan into shard_path. Return the (global)
+    indices of the dark frames, which are not written.
+    '''
+    # imported here so that the launcher does not need HXN's packages
+    try:
+        from nsls2ptycho.core.HXN_databroker import _retrieve_frames
+    except ModuleNotFoundError:
+        # for test purpose
+        from HXN_databroker import _retrieve_frames
+    import pandas as pd
+
+    n, nn, cx, cy = job['crop_args']
+    ic = job['ic']
+    points = job['points']
+    dark_frames = []
+    frames = _retrieve_frames(db, pd.Series(job['datum_ids']), start, stop, num_workers=job['num_workers'])
+    with DiffampWriter(shard_path, (n//2*2, nn//2*2), **job['writer_kwargs']) as writer:
+        i = start
+        for block in iter_blocks(frames):
+            j = i + block.shape[0]
+            data, dark = preprocess_frames(block, n, nn, cx, cy, scale=ic[0]/ic[i:j], **job['crop_kwargs'])
+            writer.append(data[~dark], points[:, i:j][:, ~dark])
+            dark_frames.extend((np.flatnonzero(dark) + i).tolist())
+            i = j
+    return dark_frames
+
+
+def merge_shards(job, shard_paths):
+    '''
+    Concatenate the shards into the output file and remove them.
+    '''
+    n, nn = job['crop_args'][:2]
+    with DiffampWriter(job['file_path'], (n//2*2, nn//2*2), **job['writer_kwargs']) as writer:
+        for shard_path in shard_paths:
+            with h5py.File(shard_path, 'r') as f:
+                writer.append_from(f['diffamp'], f['points'][:])
+        print('array size:', writer.shape)
+        writer.write_metadata(**job['metadata'])
+        writer.write_attrs(crop_key=job['crop_key'])
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+
+def main(job_path):
+    from mpi4py import MPI
+    if not MPI.Is_initialized():
+        MPI.Init()  # nsls2ptycho.core.utils turns off the automatic initialization
+    comm = MPI.COMM_WORLD
+    rank, size = comm.Get_rank(), comm.Get_size()
+
+    with open(job_path, 'rb') as f:
+        job = pickle.load(f)
+    num_frames = len(job['datum_ids'])
+    start, stop = num_frames * rank // size, num_frames * (rank+1) // size
+    shard_path = _shard_path(job['file_path'], rank)
+
+    try:
+        try:
+            from nsls2ptycho.core.HXN_databroker import hxn_db
+        except ModuleNotFoundError:
+            # for test purpose
+            from HXN_databroker import hxn_db
+        dark_frames = crop_shard(hxn_db, job, start, stop, shard_path)
+        print("[rank {}] cropped frames {}-{}".format(rank, start, stop-1), flush=True)
+    except BaseException as ex:
+        print("[ERROR] rank {} failed: {}".format(rank, ex), file=sys.stderr, flush=True)
+        comm.Abort(1)
+
+    dark_frames = comm.gather(dark_frames, root=0)
+    if rank == 0:
+        dark_frames = [i for frames in dark_frames for i in frames]
+        if len(dark_frames) > 0:
+            print("Removing the dark frames:", dark_frames, file=sys.stderr)
+        try:
+            merge_shards(job, [_shard_path(job['file_path'], r) for r in range(size)])
+        except BaseException as ex:
+            print("[ERROR] merging the shards failed: {}".format(ex), file=sys.stderr, flush=True)
+            comm.Abort(1)
+    comm.Barrier()
+    MPI.Finalize()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
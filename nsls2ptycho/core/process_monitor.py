@@ -0,0 +1,92 @@
+import codecs
+import os
+import selectors
+
+
+class ProcessMonitor(object):
+    '''
+    Relay the output of a subprocess (ex: mpirun) line by line, together with the records
+    of a telemetry channel, until the subprocess exits.
+
+    The pipes and sockets are multiplexed with a selector, so the monitor sleeps until
+    one of them has something to read: it does not spin when the subprocess is quiet, and
+    a long stdout line never holds up stderr (or vice versa). The pipes are read with
+    os.read() rather than readline(), as data sitting in a file object's buffer would be
+    invisible to the selector.
+
+    Parameters:
+        - process: subprocess.Popen
+            started with stdout=subprocess.PIPE and stderr=subprocess.PIPE
+        - on_stdout, on_stderr: callable, optional
+            called with every line (a str, including its '\\n' if any)
+        - telemetry: TelemetryReceiver, optional
+            the receiving end of a telemetry channel
+        - on_telemetry: callable, optional
+            called with the list of records returned by telemetry.read()
+    '''
+    def __init__(self, process, on_stdout=None, on_stderr=None, telemetry=None, on_telemetry=None):
+        self.process = process
+        self.on_stdout = on_stdout
+        self.on_stderr = on_stderr
+        self.telemetry = telemetry
+        self.on_telemetry = on_telemetry
+
+    def run(self):
+        '''
+        Block until the subprocess closed its output and exited; return its return code.
+        '''
+        with selectors.DefaultSelector() as sel:
+            pipes = {}
+            for pipe, callback in ((self.process.stdout, self.on_stdout), (self.process.stderr, self.on_stderr)):
+                if pipe is not None:
+                    sel.register(pipe.fileno(), selectors.EVENT_READ, 'pipe')
+                    pipes[pipe.fileno()] = [callback, b'', codecs.getincrementaldecoder('utf-8')('replace')]
+            telemetry_socks = {}
+            if self.telemetry is not None:
+                sel.register(self.telemetry, selectors.EVENT_READ, 'telemetry')
+
+            while pipes:
+                for key, _ in sel.select():
+                    if key.data == 'pipe':
+                        self._read_pipe(sel, pipes, key.fd)
+                    else:
+                        self._read_telemetry(sel, telemetry_socks)
+
+            return_value = self.process.wait()
+            if self.telemetry is not None:
+                # the records sent right before exiting
+                self._read_telemetry(sel, telemetry_socks)
+            return return_value
+
+    def _read_pipe(self, sel, pipes, fd):
+        callback, pending, decoder = pipes[fd]
+        data = os.read(fd, 65536)
+        if not data:  # EOF
+            sel.unregister(fd)
+            del pipes[fd]
+            if pending:
+                self._emit(callback, decoder.decode(pending, final=True))
+            return
+        lines = (pending + data).split(b'\n')
+        pipes[fd][1] = lines.pop()  # an incomplete line is kept until the rest arrives
+        for line in lines:
+            self._emit(callback, decoder.decode(line + b'\n'))
+
+    def _emit(self, callback, line):
+        if callback is not None:
+            callback(line)
+
+    def _read_telemetry(self, sel, telemetry_socks):
+        records = self.telemetry.read()
+        # follow the senders (re)connecting and disconnecting
+        conns = self.telemetry.connections()
+        for sock in list(telemetry_socks):
+            if sock not in conns:
+                sel.unregister(telemetry_socks.pop(sock))
+        for sock in conns:
+            if sock not in telemetry_socks:
+                telemetry_socks[sock] = sock.fileno()
+                sel.register(telemetry_socks[sock], selectors.EVENT_READ, 'telemetry')
+        if records and self.on_telemetry is not None:
+            self.on_telemetry(records)
+
@@ -0,0 +1,283 @@
+import glob
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+import h5py
+try:
+    # registers the Blosc filter with HDF5, needed for both writing and reading
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+supported_compression = ['none', 'gzip', 'lzf', 'blosc']
+supported_dtype = ['auto', 'float64', 'float32']
+
+
+def get_diffamp_dtype(h5_dtype='auto', precision='double'):
+    '''
+    Return the numpy dtype used to store diffamp. 'auto' follows the reconstruction
+    precision (float32 for 'single', float64 otherwise).
+    '''
+    if h5_dtype == 'auto':
+        h5_dtype = 'float32' if precision == 'single' else 'float64'
+    if h5_dtype not in supported_dtype:
+        raise ValueError("Unknown dtype: {}. Supported: {}".format(h5_dtype, supported_dtype))
+    return np.dtype(h5_dtype)
+
+
+def get_compression_options(compression):
+    '''
+    Return the keyword arguments for h5py's create_dataset() for the given compression
+    ('none', 'gzip', 'lzf' or 'blosc'). All of them are lossless. Blosc requires the
+    hdf5plugin package; without it lzf is used instead.
+    '''
+    if compression is None or compression == 'none':
+        return {}
+    elif compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+    elif compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    elif compression == 'blosc':
+        if hdf5plugin is None:
+            print("[WARNING] hdf5plugin is not found, so Blosc is unavailable. Use lzf instead.", file=sys.stderr)
+            return get_compression_options('lzf')
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    else:
+        raise ValueError("Unknown compression: {}. Supported: {}".format(compression, supported_compression))
+
+
+def read_frame(file_path, frame_num:int):
+    '''
+    Read a single frame of diffamp from scan_N.h5.
+    '''
+    with h5py.File(file_path, 'r') as f:
+        return f['diffamp'][frame_num]
+
+
+class DiffampWriter(object):
+    '''
+    Stream the cropped frames of a scan into scan_N.h5 block by block.
+
+    The frames and their scan coordinates are appended to resizable, chunked datasets
+    ('diffamp' and 'points'), so only the block being written needs to be in memory.
+    Frames to be discarded (ex: dark frames) are simply not appended, so the datasets
+    are compact when the writer is closed. The file is written to a temporary path
+    and moved to file_path only if no exception is raised, so an aborted crop never
+    leaves a truncated scan_N.h5 behind.
+
+    Each chunk of 'diffamp' holds chunk_frames frames (1 by default, so that reading
+    a single frame touches a single chunk), optionally compressed with one of the
+    lossless filters in supported_compression.
+
+    With swmr=True the file is written in place with HDF5's single-writer/multiple-reader
+    mode, so readers can open scan_N.h5 while it grows (ex: during a live scan). In this
+    mode write_metadata() and write_attrs() must be called before the first append(),
+    as HDF5 cannot create new objects once SWMR writing has started.
+
+    Usage:
+        with DiffampWriter(file_path, (nx, ny)) as writer:
+            for diffamp, points in ...:
+                writer.append(diffamp, points)
+            writer.write_metadata(z_m=..., lambda_nm=..., ...)
+    '''
+    def __init__(self, file_path, frame_shape, dtype=np.float64, compression=None, chunk_frames:int=1, swmr=False):
+        self.file_path = file_path
+        self.swmr = swmr
+        if swmr:
+            self._tmp_path = file_path
+            self._file = h5py.File(self._tmp_path, 'w', libver='latest')
+        else:
+            self._tmp_path = os.path.join(os.path.dirname(file_path), '.' + os.path.basename(file_path) + '.part')
+            self._file = h5py.File(self._tmp_path, 'w')
+        frame_shape = tuple(frame_shape)
+        self._diffamp = self._file.create_dataset('diffamp', shape=(0,)+frame_shape, maxshape=(None,)+frame_shape,
+                                                  chunks=(max(chunk_frames, 1),)+frame_shape, dtype=dtype,
+                                                  **get_compression_options(compression))
+        self._points = self._file.create_dataset('points', shape=(2, 0), maxshape=(2, None),
+                                                 chunks=(2, 1024), dtype=np.float64)
+
+    @property
+    def shape(self):
+        return self._diffamp.shape
+
+    def append(self, diffamp, points=None):
+        '''
+        Append a block of frames of shape (N, nx, ny) and, if given, their coordinates of shape (2, N).
+        '''
+        if self.swmr and not self._file.swmr_mode:
+            self._file.swmr_mode = True
+        start = self._diffamp.shape[0]
+        stop = start + diffamp.shape[0]
+        self._diffamp.resize(stop, axis=0)
+        self._diffamp[start:stop] = diffamp
+        if points is not None:
+            assert points.shape[1] == diffamp.shape[0]
+            self._points.resize(stop, axis=1)
+            self._points[:, start:stop] = points
+        if self.swmr:
+            self._file.flush()
+
+    def append_from(self, diffamp, points=None):
+        '''
+        Append all frames of another diffamp dataset (ex: a shard written by another
+        DiffampWriter with the same settings). With one frame per chunk, the compressed
+        chunks are copied as is, without decompressing and recompressing them.
+        '''
+        assert diffamp.shape[1:] == self._diffamp.shape[1:] and diffamp.dtype == self._diffamp.dtype
+        num_frames = diffamp.shape[0]
+        if diffamp.chunks == self._diffamp.chunks and diffamp.chunks[0] == 1 \
+           and diffamp.compression == self._diffamp.compression:
+            start = self._diffamp.shape[0]
+            self._diffamp.resize(start + num_frames, axis=0)
+            for i in range(num_frames):
+                filter_mask, chunk = diffamp.id.read_direct_chunk((i, 0, 0))
+                self._diffamp.id.write_direct_chunk((start+i, 0, 0), chunk, filter_mask)
+            if points is not None:
+                self._points.resize(start + num_frames, axis=1)
+                self._points[:, start:start+num_frames] = points
+        else:
+            for i in range(0, num_frames, 64):
+                block = diffamp[i:i+64]
+                self.append(block, points[:, i:i+64] if points is not None else None)
+
+    def write_metadata(self, **metadata):
+        for key, value in metadata.items():
+            self._file.create_dataset(key, data=value)
+
+    def write_attrs(self, **attrs):
+        for key, value in attrs.items():
+            self._file.attrs[key] = value
+
+    def close(self, discard=False):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if discard:
+            os.remove(self._tmp_path)
+        elif self._tmp_path != self.file_path:
+            os.replace(self._tmp_path, self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(discard=(exc_type is not None))
+        return False
+
+
+def to_json(obj):
+    '''
+    The default= function of json.dumps() for numpy arrays and scalars (ex: in the crop
+    inputs); anything else is converted with str().
+    '''
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+def get_crop_key(param, beamline:str, scan_num:int, num_frames:int, *crop_args, **extra):
+    '''
+    Hash everything that determines the content of a cropped scan_N.h5: the scan and
+    its total number of frames, the detector, the crop arguments given to save_data
+    (ROI, threshold, bad pixels, zero-out ROIs), the experimental parameters written to
+    the file, the storage options, and any beamline-specific inputs (extra).
+
+    State that cropping itself changes, such as param.nz and param.points after the
+    dark frames are removed, is left out so that the same crop always gets the same key.
+    '''
+    inputs = {'beamline': beamline,
+              'scan_num': int(scan_num),
+              'num_frames': int(num_frames),
+              'det_name': param.detectorkind,
+              'crop_args': crop_args,
+              'dtype': get_diffamp_dtype(param.h5_dtype, param.precision).name,
+              'compression': param.h5_compression,
+              'chunk_frames': param.h5_chunk_frames,
+              'extra': extra}
+    for key in ['z_m', 'lambda_nm', 'ccd_pixel_um', 'angle', 'x_range', 'y_range', 'dr_x', 'dr_y']:
+        inputs[key] = getattr(param, key, None)
+    inputs = json.dumps(inputs, sort_keys=True, default=to_json)
+    return hashlib.sha1(inputs.encode('utf-8')).hexdigest()
+
+
+def get_scan_file_path(param, scan_num:int, crop_key:str=None):
+    '''
+    Return the path of the cropped h5 under working_directory/h5_data/. With the crop
+    cache turned on, the name carries (part of) the crop key so that crops with
+    different settings can coexist.
+    '''
+    file_path = param.working_directory + '/h5_data/scan_' + str(scan_num)
+    if param.crop_cache_flag and crop_key is not None:
+        file_path += '_' + crop_key[:16]
+    return file_path + '.h5'
+
+
+def load_cached_scan(param, file_path, crop_key:str):
+    '''
+    If file_path is a cached crop made with the same crop key, update param with the
+    scan points actually kept in it (dark frames removed) and return True.
+    '''
+    if not param.crop_cache_flag or not os.path.isfile(file_path):
+        return False
+    with h5py.File(file_path, 'r') as f:
+        if f.attrs.get('crop_key') != crop_key:
+            return False
+        param.points = f['points'][:]
+        param.nz = f['diffamp'].shape[0]
+    os.utime(file_path)  # mark as recently used
+    print("Found cropped data with identical settings, skip cropping:", file_path)
+    return True
+
+
+def prune_cached_scans(param, scan_num:int):
+    '''
+    Keep at most param.crop_cache_size cached crops of the given scan, removing the least recently used ones.
+    '''
+    if not param.crop_cache_flag:
+        return
+    pattern = param.working_directory + '/h5_data/scan_' + str(scan_num) + '_' + '[0-9a-f]'*16 + '.h5'
+    cached = sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True)
+    for file_path in cached[max(param.crop_cache_size, 1):]:
+        os.remove(file_path)
+
+
+def get_h5_metadata(param, n:int, nn:int):
+    '''
+    Return the experimental parameters that go along with diffamp in scan_N.h5.
+    '''
+    det_distance_m = param.z_m
+    det_pixel_um = param.ccd_pixel_um
+    lambda_nm = getattr(param, 'lambda_nm', None)
+    if lambda_nm is None:
+        lambda_nm = 1.2398/param.xray_energy_kev
+    return dict(x_range=param.x_range,
+                y_range=param.y_range,
+                dr_x=param.dr_x,
+                dr_y=param.dr_y,
+                z_m=det_distance_m,
+                lambda_nm=lambda_nm,
+                ccd_pixel_um=det_pixel_um,
+                angle=param.angle,
+                x_pixel_m=lambda_nm * 1.e-9 * det_distance_m / (n * det_pixel_um * 1e-6),
+                y_pixel_m=lambda_nm * 1.e-9 * det_distance_m / (nn * det_pixel_um * 1e-6),
+                x_depth_field_m=lambda_nm * 1.e-9 / (n/2 * det_pixel_um*1.e-6 / det_distance_m)**2,
+                y_depth_field_m=lambda_nm * 1.e-9 / (nn/2 * det_pixel_um*1.e-6 / det_distance_m)**2)
+
+
+def link_scan_file(file_path, working_directory, scan_num):
+    '''
+    Symlink file_path as working_directory/scan_N.h5 so ptycho can find it.
+    '''
+    symlink_path = working_directory + '/scan_' + str(scan_num) + '.h5'
+    try:
+        os.symlink(file_path, symlink_path)
+    except FileExistsError:
+        os.remove(symlink_path)
+        os.symlink(file_path, symlink_path)
+
@@ -37,6 +37,18 @@ class Param(object):
         self.working_directory = get_working_directory()
         self.detectorkind = ''        # used to be chosen from ['merlin1', 'merlin2', 'timepix1', 'timepix2']
         self.frame_num = 0            # frame number to check
+        self.crop_num_workers = 4     # number of workers retrieving raw frames when cropping
+        self.crop_pool = 'thread'     # ['thread', 'process']
+        self.crop_mpi_processes = 1   # >1: crop with this many MPI processes via mpirun (HXN only)
+        self.h5_compression = 'none'  # ['none', 'gzip', 'lzf', 'blosc'] for diffamp in scan_N.h5
+        self.h5_chunk_frames = 1      # number of frames per HDF5 chunk of diffamp
+        self.raw_cache_flag = False   # keep the uncropped frames in working_directory/.raw_cache
+        self.raw_cache_budget_gb = 4. # size limit of the raw-frame cache
+        self.crop_cache_flag = False  # reuse h5_data/scan_N_<hash>.h5 (instead of scan_N.h5) if cropped with identical settings
+        self.crop_cache_size = 3      # number of cached crops kept per scan
+        self.h5_dtype = 'auto'        # ['auto', 'float64', 'float32'] for diffamp; 'auto' follows precision
+        self.detector_health_flag = False # update the detector's hot/dead/flicker pixel mask while cropping
+        self.detector_health_stride = 10  # analyze every n-th frame
 
         ### [Experimental parameters] ###
         self.xray_energy_kev = 0. # =1.2398/lambda_nm
@@ -141,6 +153,9 @@ class Param(object):
         self.gui = True
         self.display_interval = 5 # plot every 5 steps
         self.preview_flag = True  # turn on live preview
+        self.preview_slots = 4  # number of latest iterations ptycho keeps in shared memory for the live preview
+        self.preview_max_size = 0  # if > 0, the preview holds amplitude/phase decimated to at most this many pixels per side
+        self.preview_precision = 'single'  # precision of the decimated amplitude/phase: 'single' or 'half' (may overflow above 65504)
         self.cal_error_flag = True  # whether to calculate error in chi (fields)
         self.save_config_history = True 
         self.postprocessing_flag = True  # whether to call save_recon() to output and process results
@@ -0,0 +1,134 @@
+import itertools
+import sys
+import numpy as np
+try:
+    from nsls2ptycho.core.widgets.imgTools import rm_outlier_pixels_stack
+except ModuleNotFoundError:
+    # for test purpose
+    from widgets.imgTools import rm_outlier_pixels_stack
+
+
+# number of frames processed together by preprocess_frames() when cropping a scan
+block_size = 64
+
+
+def array_ensure_positive_elements(arr, name="array"):
+    """
+    Replace all zero or negative values in the array with the closest positive values.
+    Works only with 1D arrays. The values are replaced with the following (not preceding)
+    ones, because they are more likely to be from the same subscan (HXN); trailing values
+    are replaced with the last positive one.
+
+    The function will do nothing if there are no zeros or negative values in the array.
+    Instead of one line per value, a single summary (count and index ranges) is printed.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+        Reference to 1D numpy array. The values are modified in place.
+    name: str
+        Data name to use in error messages.
+
+    Returns
+    -------
+    int
+        The number of replaced values.
+    """
+    bad = arr <= 0
+
+    # Exit right away if there scaler data is valid (this should be true for correctly recorded scans)
+    if not np.any(bad):
+        return 0
+    if np.all(bad):
+        print(f"[WARNING] The {name} contains no positive non-zero values. Computations are likely to fail.",
+              file=sys.stderr)
+        return 0
+
+    # for every element, the index of the closest positive element at or after it
+    # (arr.size if there is none, in which case the last positive element is used)
+    idx = np.where(bad, arr.size, np.arange(arr.size))
+    idx = np.minimum.accumulate(idx[::-1])[::-1]
+    idx[idx == arr.size] = np.flatnonzero(~bad)[-1]
+    arr[bad] = arr[idx[bad]]
+
+    bad_idx = np.flatnonzero(bad)
+    splits = np.flatnonzero(np.diff(bad_idx) > 1) + 1
+    ranges = ["{}".format(r[0]) if r.size == 1 else "{}-{}".format(r[0], r[-1])
+              for r in np.split(bad_idx, splits)]
+    if len(ranges) > 10:
+        ranges = ranges[:10] + ["... ({} ranges in total)".format(len(ranges))]
+    print(f"[WARNING] {bad_idx.size} nonpositive {name} value(s) out of {arr.size} are replaced "
+          f"with the closest positive values; indices: {', '.join(ranges)}", file=sys.stderr)
+    return bad_idx.size
+
+
+def iter_blocks(frames, size=None):
+    '''
+    Group an iterable of 2D frames into 3D arrays of at most size frames each.
+    '''
+    if size is None:
+        size = block_size
+    frames = iter(frames)
+    while True:
+        block = list(itertools.islice(frames, size))
+        if len(block) == 0:
+            return
+        yield np.asarray(block)
+
+
+def preprocess_frames(frames, n:int, nn:int, cx:int, cy:int, scale=None, threshold=None, bad_pixels=None, zero_out=None):
+    '''
+    Turn a block of raw detector frames into the diffraction amplitudes used by ptycho.
+
+    Every step is applied to the whole block at once: normalization, bad-pixel removal,
+    zero-out ROIs, cropping, rotation, dark-frame detection, fftshift, thresholding and
+    square root.
+
+    Parameters:
+        - frames: np.ndarray
+            raw frames of shape (N, ny, nx); the input is not modified
+        - n: int
+            the x dimension of the ROI window (=nx_prb)
+        - nn: int
+            the y dimension of the ROI window (=ny_prb)
+        - cx: int
+            x index of the center of mass
+        - cy: int
+            y index of the center of mass
+        - scale: array of length N, optional
+            per-frame normalization factor (ex: ic[0]/ic[i])
+        - threshold: float, optional
+            the threshold of the (normalized) intensity, below which the data is removed
+        - bad_pixels: list of two lists, optional
+            the data structure is [[x1, x2, ...], [y1, y2, ...]]. If given, they will be removed from the images.
+        - zero_out: list of tuples, optional
+            zero out the given rois [(x0, y0, w0, h0), (x1, y1, w1, h1), ...]
+
+    Return:
+        (diffamp, dark): diffamp has shape (N, n//2*2, nn//2*2); dark is a boolean array of
+        length N flagging the frames that have no signal in the ROI
+    '''
+    data = np.array(frames, dtype=np.float64, ndmin=3)  # always a copy
+    if n >= data.shape[2]:
+        raise Exception("zero padding not completed yet")
+
+    if scale is not None:
+        data *= np.asarray(scale, dtype=np.float64).reshape(-1, 1, 1)
+
+    if bad_pixels is not None:
+        rm_outlier_pixels_stack(data, bad_pixels[0], bad_pixels[1])
+
+    if zero_out is not None:
+        for x0, y0, w, h in zero_out:
+            data[:, y0:y0+h, x0:x0+w] = 0.
+
+    roi = data[:, cy-nn//2:cy+nn//2, cx-n//2:cx+n//2]
+    dark = ~(np.sum(roi, axis=(1, 2)) > 0.)
+    roi = np.rot90(roi, axes=(2, 1))  # equivalent to np.flipud(arr).T for each frame
+    diffamp = np.fft.fftshift(roi, axes=(1, 2))  # this returns a contiguous copy
+    if threshold is not None:
+        diffamp[diffamp < threshold] = 0.
+    np.sqrt(diffamp, out=diffamp)
+
+    return diffamp, dark
+
@@ -0,0 +1,354 @@
+'''
+The shared memory through which ptycho hands the probe and object of recent iterations
+to the GUI's live preview.
+
+Instead of one array of shape (n_iterations, modes, nx, ny) per quantity, the preview
+is a ring of num_slots slots, so the shared memory used does not depend on the number of
+iterations. The segment "/<shm_name>_preview" is laid out as:
+
+    header (64 bytes): magic, num_slots, layout, itemsize,
+                       probe decimation factor and shape (modes, nx, ny),
+                       object decimation factor and shape (modes, nx, ny)
+    slot table:        num_slots x (sequence counter, iteration), as int64
+    slots:             num_slots x (probe, object), each slot aligned to 64 bytes
+
+With the LAYOUT_COMPLEX layout, the probe and object are stored as is (complex64 or
+complex128). With LAYOUT_PLANES, ptycho stores only what the GUI displays: the amplitude
+and phase planes, of shape (modes, 2, nx, ny), in float16 or float32 and decimated
+(every factor-th pixel) so that no side exceeds a size cap. The shapes in the header
+are the stored (decimated) ones.
+
+ptycho (rank 0, the only writer) fills the slots in turn. Each slot is guarded by a
+seqlock: the writer makes the slot's sequence counter odd, copies the arrays, records
+the iteration, and makes the counter even again. The GUI never locks: it copies a slot
+and keeps the copy only if the counter was even and unchanged across the copy, otherwise
+it retries or falls back to an older slot.
+
+The GUI learns that the segment exists and that a snapshot is ready through the POSIX
+semaphore "/<shm_name>_ready", which the GUI creates before starting ptycho (see
+PreviewWatcher): ptycho posts it once after creating the segment and once after every
+write(). The preview therefore does not depend on when ptycho's stdout is flushed. The
+GUI maps the segment as soon as it is signaled and unlinks it when the run is over, so
+ptycho exiting early never pulls the segment from under the GUI.
+'''
+import mmap
+import struct
+import sys
+import threading
+import numpy as np
+
+
+magic = b'PTYPRV01'
+_header = struct.Struct('<8s4I4I4I')
+
+LAYOUT_COMPLEX = 0
+LAYOUT_PLANES = 1
+_header_size = 64
+_align = 64
+
+# how many times a slot being rewritten is retried before giving up on it
+_max_retries = 3
+
+
+def _aligned(size):
+    return (size + _align - 1) // _align * _align
+
+
+def get_preview_shm_name(shm_name:str):
+    return "/" + shm_name + "_preview"
+
+
+def get_ready_sem_name(shm_name:str):
+    return "/" + shm_name + "_ready"
+
+
+def get_decimation(shape, max_size:int=None):
+    '''
+    Return the decimation factor bringing the last two dimensions of shape within
+    max_size pixels, and the decimated shape.
+    '''
+    modes, nx, ny = shape
+    factor = 1 if not max_size else max(1, -(-max(nx, ny) // max_size))
+    return factor, (modes, -(-nx // factor), -(-ny // factor))
+
+
+def _get_slot_shapes(layout, prb_shape, obj_shape):
+    if layout == LAYOUT_PLANES:
+        # (modes, amplitude/phase, nx, ny)
+        return (prb_shape[0], 2) + tuple(prb_shape[1:]), (obj_shape[0], 2) + tuple(obj_shape[1:])
+    return tuple(prb_shape), tuple(obj_shape)
+
+
+def get_preview_size(num_slots:int, prb_shape, obj_shape, itemsize:int, layout:int=LAYOUT_COMPLEX):
+    '''
+    Return the size in bytes of a preview segment with the given layout and stored shapes.
+    '''
+    prb_shape, obj_shape = _get_slot_shapes(layout, prb_shape, obj_shape)
+    slot_size = _aligned(itemsize * (int(np.prod(prb_shape)) + int(np.prod(obj_shape))))
+    return _aligned(_header_size + 16*num_slots) + num_slots * slot_size
+
+
+class PreviewRing(object):
+    '''
+    A view of a preview segment (see the module docstring) held in buf, ex: an mmap.
+
+    Parameters:
+        - buf: writable buffer
+            the whole segment
+        - init: tuple (num_slots, layout, dtype, (prb_factor, prb_shape), (obj_factor, obj_shape)), optional
+            if given, the header is written and all slots are marked empty (writer side);
+            otherwise the layout is read from the header (reader side). The shapes are
+            the stored ones, see get_decimation().
+    '''
+    def __init__(self, buf, init=None):
+        self._buf = buf
+        if init is not None:
+            num_slots, layout, dtype, (prb_factor, prb_shape), (obj_factor, obj_shape) = init
+            _header.pack_into(buf, 0, magic, num_slots, layout, np.dtype(dtype).itemsize, 0,
+                              prb_factor, *prb_shape, obj_factor, *obj_shape)
+        tag, num_slots, layout, itemsize, _, prb_factor, *shapes = _header.unpack_from(buf, 0)
+        if tag != magic:
+            raise ValueError("Not a preview segment (or of an incompatible version): {}".format(tag))
+        self.num_slots = num_slots
+        self.layout = layout
+        if layout == LAYOUT_PLANES:
+            self.dtype = np.dtype(np.float16 if itemsize == 2 else np.float32)
+        else:
+            self.dtype = np.dtype(np.complex64 if itemsize == 8 else np.complex128)
+        self.prb_factor, self.obj_factor = prb_factor, shapes[3]
+        self.prb_shape = tuple(shapes[:3])
+        self.obj_shape = tuple(shapes[4:])
+
+        # (sequence counter, iteration) per slot
+        self._table = np.ndarray((num_slots, 2), dtype='<i8', buffer=buf, offset=_header_size)
+        if init is not None:
+            self._table[:, 0] = 0
+            self._table[:, 1] = -1
+        prb_slot_shape, obj_slot_shape = _get_slot_shapes(layout, self.prb_shape, self.obj_shape)
+        prb_size = itemsize * int(np.prod(prb_slot_shape))
+        slot_size = _aligned(prb_size + itemsize * int(np.prod(obj_slot_shape)))
+        offset = _aligned(_header_size + 16*num_slots)
+        self._prb = [np.ndarray(prb_slot_shape, dtype=self.dtype, buffer=buf, offset=offset + k*slot_size)
+                     for k in range(num_slots)]
+        self._obj = [np.ndarray(obj_slot_shape, dtype=self.dtype, buffer=buf, offset=offset + k*slot_size + prb_size)
+                     for k in range(num_slots)]
+        self._next = 0
+
+    def write(self, it:int, prb, obj):
+        '''
+        Store the probe and object of iteration it in the oldest slot (writer side).
+        '''
+        k = self._next % self.num_slots
+        self._next += 1
+        seq = int(self._table[k, 0])
+        self._table[k, 0] = seq + 1  # odd: being written
+        if self.layout == LAYOUT_PLANES:
+            _to_planes(prb, self.prb_factor, self._prb[k])
+            _to_planes(obj, self.obj_factor, self._obj[k])
+        else:
+            self._prb[k][...] = prb
+            self._obj[k][...] = obj
+        self._table[k, 1] = it
+        self._table[k, 0] = seq + 2  # even: complete
+
+    def iterations(self):
+        '''
+        Return the iterations currently held, from the newest to the oldest.
+        '''
+        its = [int(it) for seq, it in self._table if it >= 0 and seq % 2 == 0]
+        return sorted(its, reverse=True)
+
+    def _read_slot(self, k):
+        for _ in range(_max_retries):
+            seq = int(self._table[k, 0])
+            if seq == 0:
+                return None  # never written
+            if seq % 2:
+                continue
+            it = int(self._table[k, 1])
+            prb = self._prb[k].copy()
+            obj = self._obj[k].copy()
+            if int(self._table[k, 0]) == seq:
+                return it, prb, obj
+        return None
+
+    def read(self, it:int=None):
+        '''
+        Return (iteration, probe, object) copied from the slot holding iteration it, or
+        from the newest complete slot if it is None. Return None if there is no such slot
+        (ex: it has been overwritten already). The arrays are as stored, see the layout.
+        '''
+        order = np.argsort(-self._table[:, 1], kind='stable')
+        for k in order:
+            if it is not None and int(self._table[k, 1]) != it:
+                continue
+            frame = self._read_slot(k)
+            if frame is not None and (it is None or frame[0] == it):
+                return frame
+        return None
+
+    def read_planes(self, it:int=None):
+        '''
+        Like read(), but return (iteration, probe amplitude, probe phase, object amplitude,
+        object phase), each of shape (modes, nx, ny), whatever the layout.
+        '''
+        frame = self.read(it)
+        if frame is None:
+            return None
+        it, prb, obj = frame
+        if self.layout == LAYOUT_PLANES:
+            # float16 is for storage only; not all plotting code handles it
+            prb, obj = prb.astype(np.float32, copy=False), obj.astype(np.float32, copy=False)
+            return it, prb[:, 0], prb[:, 1], obj[:, 0], obj[:, 1]
+        return it, np.abs(prb), np.angle(prb), np.abs(obj), np.angle(obj)
+
+
+def _to_planes(arr, factor, out):
+    # decimate first, so that the amplitude and phase are computed on the small array only
+    arr = arr[..., ::factor, ::factor]
+    np.abs(arr, out=out[:, 0])
+    np.arctan2(arr.imag, arr.real, out=out[:, 1])
+
+
+class SharedPreview(PreviewRing):
+    '''
+    A PreviewRing in POSIX shared memory. Use create() on the ptycho side and open() on
+    the GUI side. On the ptycho side, the GUI's readiness semaphore (if any) is posted
+    after every write().
+    '''
+    def __init__(self, shm, init=None, ready=None):
+        self._shm = shm
+        self._mm = mmap.mmap(shm.fd, shm.size)
+        self._ready = ready
+        super().__init__(self._mm, init)
+
+    def write(self, it:int, prb, obj):
+        super().write(it, prb, obj)
+        if self._ready is not None:
+            self._ready.release()
+
+    @classmethod
+    def create(cls, shm_name:str, num_slots:int, prb_shape, obj_shape, dtype, max_size:int=None):
+        '''
+        Create the segment for probes and objects of the given (full) shapes. If max_size
+        is given, the LAYOUT_PLANES layout is used, with dtype the float type of the planes;
+        otherwise the arrays are stored as is, with dtype their complex type.
+        '''
+        from posix_ipc import SharedMemory, Semaphore, O_CREX, ExistentialError
+        layout = LAYOUT_PLANES if max_size else LAYOUT_COMPLEX
+        prb = get_decimation(prb_shape, max_size)
+        obj = get_decimation(obj_shape, max_size)
+        size = get_preview_size(num_slots, prb[1], obj[1], np.dtype(dtype).itemsize, layout)
+        shm = SharedMemory(get_preview_shm_name(shm_name), O_CREX, size=size)
+        try:
+            ready = Semaphore(get_ready_sem_name(shm_name))
+        except ExistentialError:
+            ready = None  # not started by the GUI
+        preview = cls(shm, (num_slots, layout, dtype, prb, obj), ready)
+        if ready is not None:
+            ready.release()  # the segment exists
+        return preview
+
+    @classmethod
+    def create_from_param(cls, param, prb_shape, obj_shape):
+        '''
+        Create the segment as requested by the GUI's param (preview_slots, preview_max_size
+        and preview_precision).
+        '''
+        if param.preview_max_size > 0:
+            dtype = np.float16 if param.preview_precision == 'half' else np.float32
+        else:
+            dtype = np.complex64 if param.precision == 'single' else np.complex128
+        return cls.create(param.shm_name, param.preview_slots, prb_shape, obj_shape, dtype, param.preview_max_size)
+
+    @classmethod
+    def open(cls, shm_name:str):
+        # raises posix_ipc.ExistentialError if ptycho did not create it
+        from posix_ipc import SharedMemory
+        return cls(SharedMemory(get_preview_shm_name(shm_name)))
+
+    def close(self, unlink:bool=False):
+        # the arrays returned by read() are copies and stay valid
+        self._table = self._prb = self._obj = None
+        self._mm.close()
+        self._shm.close_fd()
+        if unlink:
+            self._shm.unlink()
+        if self._ready is not None:
+            self._ready.close()
+            self._ready = None
+
+
+class PreviewWatcher(threading.Thread):
+    '''
+    A thread owned by the GUI for the duration of one reconstruction. It creates the
+    readiness semaphore, sleeps on it, and reports the preview segment and the snapshots
+    as ptycho publishes them. Posts that pile up while a snapshot is handled are merged,
+    so a burst of snapshots costs one callback.
+
+    Parameters:
+        - shm_name: str
+            the prefix of the shared memory (param.shm_name)
+        - on_init: callable
+            called once the preview segment exists, with a SharedPreview opened for the
+            caller (who closes it). It is mapped as soon as ptycho signals the segment, so
+            it stays valid even if the segment is unlinked before the caller gets to it.
+        - on_snapshot: callable
+            called with the newest iteration available after each (merged) post
+    '''
+    def __init__(self, shm_name:str, on_init, on_snapshot):
+        from posix_ipc import Semaphore, O_CREX, ExistentialError
+        super().__init__(daemon=True)
+        self.shm_name = shm_name
+        self.on_init = on_init
+        self.on_snapshot = on_snapshot
+        name = get_ready_sem_name(shm_name)
+        try:
+            self._sem = Semaphore(name, O_CREX, initial_value=0)
+        except ExistentialError:
+            # left by an earlier run that did not clean up
+            Semaphore(name).unlink()
+            self._sem = Semaphore(name, O_CREX, initial_value=0)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        from posix_ipc import BusyError, ExistentialError
+        preview = None
+        last_it = None
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    self._sem.acquire(0.2)  # wake up regularly to check if we are stopped
+                except BusyError:
+                    continue
+                while True:  # merge the pending posts
+                    try:
+                        self._sem.acquire(0)
+                    except BusyError:
+                        break
+                if preview is None:
+                    try:
+                        preview = SharedPreview.open(self.shm_name)
+                        caller_preview = SharedPreview.open(self.shm_name)
+                    except (ExistentialError, ValueError) as ex:
+                        print("[WARNING] Cannot open the preview: {}".format(ex), file=sys.stderr)
+                        if preview is not None:
+                            preview.close()
+                            preview = None
+                        continue
+                    self.on_init(caller_preview)
+                its = preview.iterations()
+                if its and its[0] != last_it:
+                    last_it = its[0]
+                    self.on_snapshot(last_it)
+        finally:
+            if preview is not None:
+                preview.close()  # the GUI unlinks it
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self._sem.unlink()
+        self._sem.close()
+
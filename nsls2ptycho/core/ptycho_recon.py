@@ -4,13 +4,16 @@ from nsls2ptycho.core.ptycho_param import Param
 import sys, os
 import pickle     # dump param into disk
 import subprocess # call mpirun from shell
-from fcntl import fcntl, F_GETFL, F_SETFL
-from os import O_NONBLOCK
 import numpy as np
+import threading
 import traceback
+from collections import OrderedDict
 
-from nsls2ptycho.core.databroker_api import load_metadata, save_data
+from nsls2ptycho.core.databroker_api import load_metadata, save_data, get_single_image, get_detector_names, get_db
 from nsls2ptycho.core.utils import use_mpi_machinefile, set_flush_early
+from nsls2ptycho.core.ptycho_telemetry import TelemetryReceiver, RECORD_ITERATION, RECORD_INIT_MMAP
+from nsls2ptycho.core.process_monitor import ProcessMonitor
+from nsls2ptycho.core.ptycho_preview import PreviewWatcher
 
 
 class PtychoReconWorker(QtCore.QThread):
@@ -73,11 +76,45 @@ class PtychoReconWorker(QtCore.QThread):
 
         return counter
 
-    def _parse_one_line(self):
-        stdout_2 = self.process.stdout.readline().decode('utf-8')
-        print(stdout_2, end='') # because the line already ends with '\n'
+    def _on_stdout(self, line, telemetry, update_fcn):
+        print(line, end='') # because the line already ends with '\n'
+        if telemetry.received > 0 or update_fcn is None:
+            return # the progress comes from the telemetry, the lines are only logged
+
+        tokens = line.split()
+        if self._pending_info is not None:
+            # the rest of an [INFO] message that was split over several lines
+            tokens = self._pending_info + tokens
+            self._pending_info = None
+        elif len(tokens) == 3 and tokens[0] == "shared":
+            update_fcn(-1, "init_mmap")
+            return
+        elif not (len(tokens) > 2 and tokens[0] == "[INFO]"):
+            return
+
+        # check if the message is complete by examining the number of "="
+        counter = self._test_stdout_completeness(tokens)
+        if counter < 3:
+            self._pending_info = tokens
+        else: # counter > 3 means we read one more line
+            try:
+                if counter > 3:
+                    raise ValueError("too many fields")
+                it, result = self._parse_message(tokens)
+            except (ValueError, IndexError) as ex:
+                print("[WARNING] Cannot parse the progress message ({}), skipped: {}".format(ex, ' '.join(tokens)),
+                      file=sys.stderr)
+            else:
+                update_fcn(it+1, result)
 
-        return stdout_2.split()
+    def _relay_telemetry(self, records, update_fcn):
+        for kind, it, result in records:
+            if update_fcn is None:
+                continue
+            if kind == RECORD_ITERATION:
+                update_fcn(it+1, result)
+            elif kind == RECORD_INIT_MMAP:
+                update_fcn(-1, "init_mmap")
 
     def recon_api(self, param:Param, update_fcn=None):
         # "1" is just a placeholder to be overwritten soon
@@ -97,60 +134,38 @@ class PtychoReconWorker(QtCore.QThread):
         # for CuPy v8.0+
         os.environ['CUPY_ACCELERATORS'] = 'cub'
                 
+        # ptycho signals the preview snapshots through a semaphore if it supports it
+        watcher = None
+        if param.preview_flag and update_fcn is not None:
+            try:
+                watcher = PreviewWatcher(param.shm_name,
+                                         on_init=lambda preview: update_fcn(-1, preview),
+                                         on_snapshot=lambda it: update_fcn(it+1, "preview"))
+                watcher.start()
+            except Exception as ex:
+                print("[WARNING] Live preview signaling is disabled: {}".format(ex), file=sys.stderr)
+                watcher = None
+
         try:
             self.return_value = None
-            with subprocess.Popen(mpirun_command,
+            # ptycho reports its progress through the telemetry socket if it supports it,
+            # otherwise the [INFO] lines in stdout are parsed
+            with TelemetryReceiver() as telemetry, \
+                 subprocess.Popen(mpirun_command,
                                   stdout=subprocess.PIPE,
                                   stderr=subprocess.PIPE,
-                                  env=dict(os.environ, mpi_warn_on_fork='0')) as run_ptycho:
+                                  env=dict(os.environ, mpi_warn_on_fork='0', **telemetry.env)) as run_ptycho:
                 self.process = run_ptycho # register the subprocess
+                self._pending_info = None
 
-                # idea: if we attempts to readline from an empty pipe, it will block until 
-                # at least one line is piped in. However, stderr is ususally empty, so reading
-                # from it is very likely to block the output until the subprocess ends, which 
-                # is bad. Thus, we want to set the O_NONBLOCK flag for stderr, see
-                # http://eyalarubas.com/python-subproc-nonblock.html 
-                #
-                # Note that it is unclear if readline in Python 3.5+ is guaranteed safe with 
-                # non-blocking pipes or not. See https://bugs.python.org/issue1175#msg56041 
-                # and https://stackoverflow.com/questions/375427/
-                # If this is a concern, using the asyncio module could be a safer approach?
-                # One could also process stdout in one loop and then stderr in another, which
-                # will not have the blocking issue.
-                flags = fcntl(run_ptycho.stderr, F_GETFL) # first get current stderr flags
-                fcntl(run_ptycho.stderr, F_SETFL, flags | O_NONBLOCK)
-
-                while True:
-                    stdout = run_ptycho.stdout.readline()
-                    stderr = run_ptycho.stderr.readline() # without O_NONBLOCK this will very likely block
-                    if (run_ptycho.poll() is not None) and (stdout==b'') and (stderr==b''):
-                        break
-
-                    if stdout:
-                        stdout = stdout.decode('utf-8')
-                        print(stdout, end='') # because the line already ends with '\n'
-                        stdout = stdout.split()
-                        if len(stdout) > 2 and stdout[0] == "[INFO]" and update_fcn is not None:
-                            # TEST: check if stdout is complete by examining the number of "="
-                            # TODO: improve this ugly hack...
-                            while True:
-                                counter = self._test_stdout_completeness(stdout)
-                                if counter == 3:
-                                    break
-                                elif counter < 3:
-                                    stdout += self._parse_one_line()
-                                else: # counter > 3, we read one more line!
-                                    raise Exception("parsing error")
-                          
-                            it, result = self._parse_message(stdout)
-                            #print(result['probe_chi'])
-                            update_fcn(it+1, result)
-                        elif len(stdout) == 3 and stdout[0] == "shared" and update_fcn is not None:
-                            update_fcn(-1, "init_mmap")
-
-                    if stderr:
-                        stderr = stderr.decode('utf-8')
-                        print(stderr, file=sys.stderr, end='')
+                # stdout, stderr and the telemetry are multiplexed with a selector, so that we
+                # sleep while ptycho is quiet, and reading one stream never blocks the others
+                monitor = ProcessMonitor(run_ptycho,
+                                         on_stdout=lambda line: self._on_stdout(line, telemetry, update_fcn),
+                                         on_stderr=lambda line: print(line, file=sys.stderr, end=''),
+                                         telemetry=telemetry,
+                                         on_telemetry=lambda records: self._relay_telemetry(records, update_fcn))
+                monitor.run()
 
                 # get the return value 
                 self.return_value = run_ptycho.poll()
@@ -164,6 +179,8 @@ class PtychoReconWorker(QtCore.QThread):
             #print(ex, file=sys.stderr)
             #raise ex
         finally:
+            if watcher is not None:
+                watcher.stop()
             # clean up temp file
             filepath = param.working_directory + "/." + param.shm_name + ".txt"
             if os.path.isfile(filepath):
@@ -247,6 +264,116 @@ class HardWorker(QtCore.QThread):
             update_fcn(0, metadata) # 0 is just a placeholder
 
 
+class MetadataPrefetcher(QtCore.QThread):
+    '''
+    Speculatively fetch the detector list, the metadata and the first frame of scans
+    in the background (ex: as soon as a scan number is typed), so that "Load" and
+    "View & set" can be answered from a small cache instead of the database.
+
+    Requests are served in the order given to prefetch(); requests that are still
+    pending when new ones arrive are dropped. Relative scan ids (<= 0) are not prefetched,
+    and only the detector list is cached for scans still in progress (no stop document),
+    as their metadata (ex: nz and the points) would go stale; "Load" queries those again.
+    If db is None, the beamline's Broker is obtained in the thread on the first request.
+    '''
+    def __init__(self, db=None, cache_size:int=8, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.cache_size = cache_size
+        self._cache = OrderedDict() # scan_id -> {'det_names': ..., det_name: (metadata, frame)}
+        self._pending = []          # [(scan_id, det_name), ...], next one first
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+
+    def prefetch(self, scan_ids, det_name:str=''):
+        '''
+        Replace the pending requests by the given scans (an int or a list, the first is
+        fetched first). If det_name is not used in a scan, its first detector is taken,
+        as "Load" does.
+        '''
+        if isinstance(scan_ids, int):
+            scan_ids = [scan_ids]
+        with self._lock:
+            self._pending = [(int(scan_id), det_name) for scan_id in scan_ids]
+            self._wakeup.notify()
+
+    def get_detector_names(self, scan_id:int):
+        with self._lock:
+            entry = self._cache.get(scan_id)
+            return None if entry is None else entry['det_names']
+
+    def get_metadata(self, scan_id:int, det_name:str):
+        '''
+        Return a (shallow) copy of the cached metadata, or None if not prefetched.
+        '''
+        with self._lock:
+            entry = self._cache.get(scan_id)
+            if entry is None or det_name not in entry:
+                return None
+            self._cache.move_to_end(scan_id)
+            return dict(entry[det_name][0])
+
+    def get_frame(self, scan_id:int, det_name:str, frame_num:int=0):
+        '''
+        Return a copy of the prefetched frame, or None. Only the first frame is prefetched.
+        '''
+        with self._lock:
+            entry = self._cache.get(scan_id)
+            if frame_num != 0 or entry is None or det_name not in entry or entry[det_name][1] is None:
+                return None
+            return np.array(entry[det_name][1])
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def _store(self, scan_id, key, value):
+        with self._lock:
+            entry = self._cache.setdefault(scan_id, {})
+            entry[key] = value
+            self._cache.move_to_end(scan_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                scan_id, det_name = self._pending.pop(0)
+                if scan_id <= 0:
+                    continue
+                entry = self._cache.get(scan_id, {})
+                det_names = entry.get('det_names')
+
+            try:
+                if self.db is None:
+                    self.db = get_db()
+                if det_names is None:
+                    det_names = get_detector_names(self.db, scan_id)
+                    self._store(scan_id, 'det_names', det_names)
+                if det_name not in det_names:
+                    if len(det_names) == 0:
+                        continue
+                    det_name = det_names[0]
+                if det_name in entry or not self.db[scan_id].stop:
+                    continue
+
+                metadata = load_metadata(self.db, scan_id, det_name)
+                frame = None
+                if metadata.get('mds_table') is not None:
+                    frame = get_single_image(self.db, 0, metadata['mds_table'])
+                self._store(scan_id, det_name, (metadata, frame))
+            except Exception as ex:
+                # most likely a scan that does not exist (yet); "Load" will report it if needed
+                print("[WARNING] Cannot prefetch scan {}: {}".format(scan_id, ex), file=sys.stderr)
+                continue
+
+
 class PtychoReconFakeWorker(QtCore.QThread):
     update_signal = QtCore.pyqtSignal(int, object)
 
@@ -0,0 +1,208 @@
+'''
+A typed channel carrying the progress of a reconstruction (ptycho, run by mpirun) to the
+GUI, instead of printing it as [INFO] lines to stdout and parsing them back.
+
+The GUI listens on a Unix-domain socket and passes its path to the job in the
+NSLS2PTYCHO_TELEMETRY environment variable. Rank 0 of the job connects and sends one
+packet per record: a fixed-size header (record kind, iteration, algorithm, timing and
+the length of each metric array) followed by the metric arrays as float64, so decoding
+a record is one struct unpack plus np.frombuffer. The socket is of type SOCK_SEQPACKET,
+which keeps the record boundaries (a record never arrives split) and, unlike datagrams
+(at most 10 queued by default on Linux), buffers as many records as fit in the socket
+buffer.
+
+On the ptycho side:
+
+    telemetry = TelemetrySender.from_env()  # None if the GUI did not ask for it
+    ...
+    if telemetry is not None:
+        telemetry.send_iteration(it, 'DM', elapsed, probe_chi=..., object_chi=..., diff_chi=...)
+
+If the variable is not set or the socket cannot be reached (ex: rank 0 runs on another
+node), the sender is disabled and ptycho should keep printing its [INFO] lines, which
+the GUI still understands.
+'''
+import os
+import socket
+import struct
+import sys
+import tempfile
+import numpy as np
+
+
+env_name = 'NSLS2PTYCHO_TELEMETRY'
+
+RECORD_ITERATION = 1
+RECORD_INIT_MMAP = 2  # the shared memory for the live preview is ready
+
+# the metric arrays, in the order they follow the header
+metric_names = ('probe_chi', 'object_chi', 'diff_chi')
+
+# kind, iteration, algorithm (ASCII), elapsed time of the iteration in seconds, and one length per metric
+_header = struct.Struct('<BI8sd' + 'H'*len(metric_names))
+
+
+def encode(kind:int, it:int=0, alg:str='', elapsed:float=0., **metrics):
+    '''
+    Pack a record into bytes. The metrics are given as keyword arguments named after
+    metric_names, each a scalar or a 1D array; missing ones are sent empty.
+    '''
+    arrays = [np.asarray(metrics.get(name, ()), dtype='<f8').ravel() for name in metric_names]
+    header = _header.pack(kind, it, alg.encode('ascii')[:8], elapsed, *[arr.size for arr in arrays])
+    return b''.join([header] + [arr.tobytes() for arr in arrays])
+
+
+def decode(buf):
+    '''
+    Unpack a record.
+
+    Return:
+        (kind, it, result): result is a dictionary holding 'alg', 'elapsed' and one list
+        per metric (ex: result['probe_chi']), as expected by the GUI's update functions
+    '''
+    kind, it, alg, elapsed, *lengths = _header.unpack_from(buf)
+    values = np.frombuffer(buf, dtype='<f8', offset=_header.size)
+    if values.size != sum(lengths):
+        raise ValueError("Truncated telemetry record: {} values instead of {}".format(values.size, sum(lengths)))
+    result = {'alg': alg.rstrip(b'\0').decode('ascii'), 'elapsed': elapsed}
+    start = 0
+    for name, length in zip(metric_names, lengths):
+        result[name] = values[start:start+length].tolist()
+        start += length
+    return kind, it, result
+
+
+class TelemetrySender(object):
+    '''
+    The sending end, used by the reconstruction (rank 0 only).
+
+    Sending never blocks: if the GUI falls behind and the socket buffer is full, the
+    record is dropped, as a missing point in the chi plots is better than a stalled
+    reconstruction.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.dropped = 0
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._connected = False
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Return a sender if the GUI passed a socket path in the environment, else None.
+        '''
+        path = os.environ.get(env_name)
+        return cls(path) if path else None
+
+    @property
+    def enabled(self):
+        return self._sock is not None
+
+    def send_iteration(self, it:int, alg:str, elapsed:float, **metrics):
+        return self._send(encode(RECORD_ITERATION, it, alg, elapsed, **metrics))
+
+    def send_init_mmap(self):
+        return self._send(encode(RECORD_INIT_MMAP))
+
+    def _send(self, buf):
+        if self._sock is None:
+            return False
+        try:
+            if not self._connected:
+                self._sock.connect(self.path)
+                self._sock.setblocking(False)
+                self._connected = True
+            self._sock.send(buf)
+        except BlockingIOError:
+            self.dropped += 1
+            return False
+        except OSError as ex:
+            # ex: the GUI is gone, or it runs on another node
+            print("[WARNING] Telemetry is disabled: {}".format(ex), file=sys.stderr)
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class TelemetryReceiver(object):
+    '''
+    The receiving end, owned by the GUI for the duration of one reconstruction. The
+    socket file is created in the temporary directory (socket paths are limited to ~100
+    characters) and removed by close().
+    '''
+    def __init__(self, path:str=None):
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'ptycho_{}_{}.sock'.format(os.getpid(), id(self)))
+        self.path = path
+        self.received = 0
+        if os.path.exists(path):
+            os.remove(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._sock.bind(path)
+        self._sock.listen(4)
+        self._sock.setblocking(False)
+        self._conns = []  # one per sender, normally only rank 0
+
+    @property
+    def env(self):
+        # to be merged into the environment of the job
+        return {env_name: self.path}
+
+    def fileno(self):
+        # the listening socket; becomes readable when a sender connects
+        return self._sock.fileno()
+
+    def connections(self):
+        # the connected senders; readable when records are pending
+        return list(self._conns)
+
+    def read(self):
+        '''
+        Return the list of the records received so far, as decoded by decode(); never blocks.
+        '''
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except BlockingIOError:
+                break
+            conn.setblocking(False)
+            self._conns.append(conn)
+
+        records = []
+        for conn in list(self._conns):
+            while True:
+                try:
+                    buf = conn.recv(65536)
+                except BlockingIOError:
+                    break
+                if not buf:  # the sender is done
+                    conn.close()
+                    self._conns.remove(conn)
+                    break
+                try:
+                    records.append(decode(buf))
+                except (struct.error, ValueError, UnicodeDecodeError) as ex:
+                    print("[WARNING] Ignored a malformed telemetry record: {}".format(ex), file=sys.stderr)
+        self.received += len(records)
+        return records
+
+    def close(self):
+        if self._sock is not None:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
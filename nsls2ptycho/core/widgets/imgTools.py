@@ -1,3 +1,4 @@
+import functools
 import numpy as np
 from scipy.ndimage import median_filter
 
@@ -9,11 +10,68 @@ def rm_outlier_pixels(data, rows, cols, set_to_zero=False):
         data[rows, cols] = 0.
     else:
         assert(len(rows) == len(cols))
-        for x, y in zip(rows, cols):
-            data[x,y] = np.median(data[x-1:x+1,y-1:y+1])
+        rm_outlier_pixels_stack(data[np.newaxis], rows, cols)
     return data
 
 
+def rm_outlier_pixels_stack(data, rows, cols):
+    '''
+    Replace the given pixels in every frame of data, of shape (N, height, width), by the
+    median of the 2x2 window data[:, x-1:x+1, y-1:y+1] (the window is moved inward
+    for pixels on the first row/column). The result is the same as calling
+    rm_outlier_pixels() on each frame, but all frames are fixed at once.
+
+    WARNING: this function mutates the input array "data"!!!
+    '''
+    for index, neighbors in get_bad_pixel_table(rows, cols, data.shape[1:]):
+        data[:, index[0], index[1]] = np.median(data[:, neighbors[0], neighbors[1]], axis=2)
+    return data
+
+
+def get_bad_pixel_table(rows, cols, shape):
+    '''
+    Precompute the indices used by rm_outlier_pixels_stack() for a bad-pixel list.
+
+    Returns a list of (index, neighbors) pairs, where index is a (2, P) array of bad
+    pixels and neighbors is a (2, P, 4) array of their median windows. A pixel is fixed
+    one after the other in the given order, so a window may contain previously fixed
+    pixels; the pixels are grouped such that each group only reads values written by
+    earlier groups, and every group can be fixed in one vectorized step.
+    '''
+    return _get_bad_pixel_table(tuple(int(x) for x in rows), tuple(int(y) for y in cols), tuple(shape))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_bad_pixel_table(rows, cols, shape):
+    height, width = shape
+    last_write = {}  # pixel -> group of its latest replacement
+    last_read = {}   # pixel -> latest group reading it
+    groups = []
+    for x, y in zip(rows, cols):
+        if not (0 <= x < height and 0 <= y < width):
+            raise IndexError("bad pixel ({}, {}) is out of the image of shape {}".format(x, y, shape))
+        x0 = x-1 if x > 0 else min(x+1, height-1)
+        y0 = y-1 if y > 0 else min(y+1, width-1)
+        window = [(x0, y0), (x0, y), (x, y0), (x, y)]
+        group = max([last_write[p]+1 for p in window if p in last_write] + [last_read.get((x, y), 0), 0])
+        if group == len(groups):
+            groups.append(([], []))
+        groups[group][0].append((x, y))
+        groups[group][1].append(window)
+        last_write[(x, y)] = group
+        for p in window:
+            last_read[p] = max(last_read.get(p, 0), group)
+
+    table = []
+    for index, neighbors in groups:
+        index = np.array(index, dtype=np.intp).T
+        neighbors = np.moveaxis(np.array(neighbors, dtype=np.intp), 2, 0)
+        index.flags.writeable = False
+        neighbors.flags.writeable = False
+        table.append((index, neighbors))
+    return table
+
+
 def find_outlier_pixels(data,tolerance=3,worry_about_edges=True, get_fixed_image=False):
     #This function finds the hot or dead pixels in a 2D dataset.
     #tolerance is the number of standard deviations used to cutoff the hot pixels
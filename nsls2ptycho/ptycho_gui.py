@@ -7,15 +7,17 @@ from PyQt5.QtWidgets import QFileDialog, QAction
 from nsls2ptycho.ui import ui_ptycho
 from nsls2ptycho.core.utils import clean_shared_memory, get_mpi_num_processes, parse_range
 from nsls2ptycho.core.ptycho_param import Param
-from nsls2ptycho.core.ptycho_recon import PtychoReconWorker, PtychoReconFakeWorker, HardWorker
+from nsls2ptycho.core.ptycho_recon import PtychoReconWorker, PtychoReconFakeWorker, HardWorker, MetadataPrefetcher
 from nsls2ptycho.core.ptycho_qt_utils import PtychoStream
+from nsls2ptycho.core.ptycho_h5 import read_frame
+from nsls2ptycho.core.ptycho_preview import SharedPreview, get_preview_shm_name
 from nsls2ptycho.core.widgets.list_widget import ListWidget
 from nsls2ptycho.core.widgets.mplcanvas import load_image_pil
 from nsls2ptycho.core.ptycho.utils import parse_config
 from nsls2ptycho._version import __version__
 
 # databroker related
-from nsls2ptycho.core.databroker_api import db, load_metadata, get_single_image, get_detector_names, beamline_name
+from nsls2ptycho.core.databroker_api import get_db, load_metadata, get_single_image, get_detector_names, beamline_name
 
 from nsls2ptycho.reconStep_gui import ReconStepWindow
 from nsls2ptycho.roi_gui import RoiWindow
@@ -62,6 +64,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
 
         #self.le_scan_num.editingFinished.connect(self.forceLoad) # too sensitive, why?
         self.le_scan_num.textChanged.connect(self.forceLoad)
+        self.le_scan_num.textChanged.connect(self.schedulePrefetch)
         self.cb_dataloader.currentTextChanged.connect(self.forceLoad)
         self.cb_detectorkind.currentTextChanged.connect(self.forceLoad)
 
@@ -106,6 +109,8 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             self.param = param
         self._prb = None
         self._obj = None
+        self._preview = None # the ring buffer of recent iterations, if ptycho provides it
+        self._preview_signaled = False # True once ptycho signals the snapshots through the semaphore
         self._ptycho_gpu_thread = None
         self._worker_thread = None
         self._db = None             # hold the Broker instance that contains the info of the given scan id
@@ -124,6 +129,16 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         self.roiWindow = None
         self.scanWindow = None
 
+        # prefetch the metadata of the scan being typed in the background
+        self._prefetcher = None
+        self._prefetch_timer = QtCore.QTimer(self)
+        self._prefetch_timer.setSingleShot(True)
+        self._prefetch_timer.setInterval(500) # ms; wait for the user to finish typing
+        self._prefetch_timer.timeout.connect(self._prefetchScan)
+        if beamline_name is not None:
+            self._prefetcher = MetadataPrefetcher() # connects to the database on the first prefetch
+            self._prefetcher.start()
+
         # temporary solutions
         self.ck_ms_pie_flag.setEnabled(False)
         self.ck_weak_obj_flag.setEnabled(False)
@@ -174,7 +189,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
     @db.setter
     def db(self, scan_id:int):
         # TODO: this should be configured based on selected beamline profile!
-        self._db = db
+        self._db = get_db() # the backend is imported and connected on first use
 
 
     def resetButtons(self):
@@ -191,6 +206,7 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         if self._obj is not None:
             del self._obj
             self._obj = None
+        self._preview_signaled = False
         #if self._scan_points is not None:
         #    del self._scan_points
         #    self._scan_points = None
@@ -597,8 +613,25 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
                 self.scanWindow.reset_window()
 
 
-    def init_mmap(self):
+    def init_mmap(self, preview=None):
         p = self.param
+
+        # ptycho keeps only the latest iterations in a ring buffer if it supports it,
+        # otherwise all iterations are mapped. The preview watcher hands over the ring
+        # buffer already mapped, as ptycho may exit and unlink it before we get here
+        if self._preview is not None:
+            if preview is not None:
+                preview.close()
+            return # already signaled, through both the semaphore and stdout
+        if preview is not None:
+            self._preview = preview
+            return
+        try:
+            self._preview = SharedPreview.open(p.shm_name)
+            return
+        except ExistentialError:
+            self._preview = None
+
         datasize = 8 if p.precision == 'single' else 16
         datatype = np.complex64 if p.precision == 'single' else np.complex128
 
@@ -621,11 +654,61 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             self._obj = np.ndarray(shape=(p.n_iterations, 1, nx_obj, ny_obj), dtype=datatype, buffer=mm_list[2], order='C')
 
 
+    def _get_preview(self, it):
+        # the (probe amplitude, probe phase, object amplitude, object phase) of iteration it (0-based),
+        # or Nones if not available (anymore); with a decimated preview, they come precomputed by ptycho
+        if self._preview is not None:
+            frame = self._preview.read_planes(it)
+            if frame is None:
+                # overwritten already, as ptycho runs ahead of us: show the latest instead
+                frame = self._preview.read_planes()
+            if frame is None:
+                return None, None, None, None
+            return frame[1:]
+        elif self._prb is not None:
+            return np.abs(self._prb[it]), np.angle(self._prb[it]), np.abs(self._obj[it]), np.angle(self._obj[it])
+        return None, None, None, None
+
+
+    def _get_preview_images(self, it):
+        prb_amp, prb_pha, obj_amp, obj_pha = self._get_preview(it-1)
+        if self.param.mode_flag:
+            images = []
+            for i in range(self.param.obj_mode_num):
+                images.append(np.rot90(obj_pha[i]))
+                images.append(np.rot90(obj_amp[i]))
+            for i in range(self.param.prb_mode_num):
+                images.append(np.rot90(prb_amp[i]))
+                images.append(np.rot90(prb_pha[i]))
+        elif self.param.multislice_flag:
+            images = []
+            for i in range(self.param.slice_num):
+                images.append(np.rot90(obj_pha[i]))
+                images.append(np.rot90(obj_amp[i]))
+            #TODO: decide which probe we'd like to present
+            images.append(np.rot90(prb_amp[0]))
+            images.append(np.rot90(prb_pha[0]))
+        else:
+            images = [np.rot90(obj_pha[0]),
+                      np.rot90(obj_amp[0]),
+                      np.rot90(prb_amp[0]),
+                      np.rot90(prb_pha[0])]
+        return images
+
+
     def close_mmap(self):
         # We close shared memory as long as the backend is terminated either normally or 
         # abnormally. The subtlety here is that the monitor should still be able to access
         # the intermediate results after mmaps' are closed. A potential segfault is avoided 
         # by accessing the transformed results, which are buffered, not the original ones.
+        if self._preview is not None:
+            self._preview.close(unlink=True)
+            self._preview = None
+        else:
+            try:
+                SharedMemory(get_preview_shm_name(self.param.shm_name)).unlink()
+            except ExistentialError:
+                pass
         try:
             global mm_list, shm_list
             for mm, shm in zip(mm_list, shm_list):
@@ -648,15 +731,21 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
     def update_recon_step(self, it, data=None):
         self.recon_bar.setValue(it)
 
+        if isinstance(data, SharedPreview) and \
+           (self.reconStepWindow is None or _TEST or not self.ck_preview_flag.isChecked()):
+            # the preview mapped for us by the watcher is not displayed; stop() unlinks the segment
+            data.close()
+            data = None
+
         if self.reconStepWindow is not None:
             self.reconStepWindow.update_iter(it)
 
             if not _TEST and self.ck_preview_flag.isChecked():
                 try:
-                    if it == -1 and data == 'init_mmap':
+                    if it == -1 and (data == 'init_mmap' or isinstance(data, SharedPreview)):
                         try:
                             # the two npy are created by ptycho by this time
-                            self.init_mmap()
+                            self.init_mmap(data if isinstance(data, SharedPreview) else None)
                         except ExistentialError:
                             # user may kill the process prematurely
                             self.stop()
@@ -726,29 +815,14 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
                                 images.append( np.rot90(np.angle(data['prb_'+sol])) )
 
                         self.reconStepWindow.update_images(it, images)
+                    elif data == 'preview':
+                        # a new snapshot, signaled by ptycho through the semaphore
+                        self._preview_signaled = True
+                        self.reconStepWindow.update_images(it, self._get_preview_images(it))
                     elif (it-1) % self.param.display_interval == 0:
-                        if self.param.mode_flag:
-                            images = []
-                            for i in range(self.param.obj_mode_num):
-                                images.append(np.rot90(np.angle(self._obj[it-1, i])))
-                                images.append(np.rot90(np.abs(self._obj[it-1, i])))
-                            for i in range(self.param.prb_mode_num):
-                                images.append(np.rot90(np.abs(self._prb[it-1, i])))
-                                images.append(np.rot90(np.angle(self._prb[it-1, i])))
-                        elif self.param.multislice_flag:
-                            images = []
-                            for i in range(self.param.slice_num):
-                                images.append(np.rot90(np.angle(self._obj[it-1, i])))
-                                images.append(np.rot90(np.abs(self._obj[it-1, i])))
-                            #TODO: decide which probe we'd like to present
-                            images.append(np.rot90(np.abs(self._prb[it-1, 0])))
-                            images.append(np.rot90(np.angle(self._prb[it-1, 0])))
-                        else:
-                            images = [np.rot90(np.angle(self._obj[it-1, 0])),
-                                      np.rot90(np.abs(self._obj[it-1, 0]  )),
-                                      np.rot90(np.abs(self._prb[it-1, 0]  )),
-                                      np.rot90(np.angle(self._prb[it-1, 0]))]
-                        self.reconStepWindow.update_images(it, images)
+                        if not self._preview_signaled:
+                            # no semaphore: the snapshot is ready once its iteration is printed
+                            self.reconStepWindow.update_images(it, self._get_preview_images(it))
                         self.reconStepWindow.update_metric(it, data)
 
                 except TypeError as ex: # when MPI processes are terminated, _prb and _obj are deleted and so not subscriptable 
@@ -1019,6 +1093,9 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         if len(self._scan_numbers) > 0:
             scan_num = self._scan_numbers.pop()
             print("[BATCH] begin processing scan " + str(scan_num) + "...")
+            if self._prefetcher is not None:
+                # get the next few scans ready while this one is processed
+                self._prefetcher.prefetch(self._scan_numbers[::-1][:3], self.cb_detectorkind.currentText())
             self.le_scan_num.setText(str(scan_num))
             self.btn_recon_batch_start.setEnabled(False)
             self.btn_recon_batch_stop.setEnabled(True)
@@ -1137,7 +1214,11 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         if not self._loaded:
             raise RuntimeError("[ERROR] Need to click the \"load\" button before viewing.")
         if self._mds_table is not None:
-            return get_single_image(self._db, frame_num, self._mds_table)
+            if self._prefetcher is not None:
+                img = self._prefetcher.get_frame(int(self.le_scan_num.text()), self.cb_detectorkind.currentText(), frame_num)
+                if img is not None:
+                    return img
+            return get_single_image(self._db, frame_num, self._mds_table, param=self.param)
         else:
             scan_num = int(self.le_scan_num.text())
             items = []
@@ -1161,12 +1242,9 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
             message = "[ERROR] The {0}-th frame doesn't exist. "
             message += "Available frames for the chosen scan: [0, {1}]."
             raise ValueError(message.format(frame_num, length-1))
-        with h5py.File(working_dir+'/scan_'+scan_num+'.h5','r') as f:
-            print("h5 loaded, parsing the {}-th frame...".format(frame_num), end='')
-            img = f['diffamp'][frame_num]
-            #data = f['diffamp'].value
-            #img = data[frame_num]
-            print("done")
+        print("loading the {}-th frame from h5...".format(frame_num), end='')
+        img = read_frame(working_dir+'/scan_'+scan_num+'.h5', frame_num)
+        print("done")
         return img
 
 
@@ -1205,10 +1283,11 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
     #@profile
     def _loadExpParamBroker(self, scan_id:int):
         self.db = scan_id # set the correct database
-        header = self.db[scan_id]
 
         # get the list of detector names
-        det_names = get_detector_names(self.db, scan_id)
+        det_names = self._prefetcher.get_detector_names(scan_id) if self._prefetcher is not None else None
+        if det_names is None:
+            det_names = get_detector_names(self.db, scan_id)
         det_name = self.cb_detectorkind.currentText()
         det_name_exists = False
         self.cb_detectorkind.clear()
@@ -1219,6 +1298,14 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         if not det_name_exists:
             det_name = self.cb_detectorkind.currentText()
 
+        # use the prefetched metadata if available; the slot is queued so that the signal
+        # it emits is never delivered before the caller is ready for it (see _batch_crop)
+        metadata = self._prefetcher.get_metadata(scan_id, det_name) if self._prefetcher is not None else None
+        if metadata is not None:
+            print("loading begins (prefetched)...", end='')
+            QtCore.QTimer.singleShot(0, lambda: self._setExpParamBroker(0, metadata))
+            return
+
         # get metadata
         thread = self._worker_thread \
                = HardWorker("fetch_data", self.db, scan_id, det_name)
@@ -1368,6 +1455,22 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
         self.sp_num_points.setValue(0)
 
     
+    def schedulePrefetch(self):
+        self._prefetch_timer.start() # restart the countdown on every keystroke
+
+
+    def _prefetchScan(self):
+        if self._prefetcher is None or self._scan_numbers is not None: # batch mode handles its own
+            return
+        if self.cb_dataloader.currentText() != "Load from databroker":
+            return
+        try:
+            scan_id = int(self.le_scan_num.text())
+        except ValueError:
+            return
+        self._prefetcher.prefetch(scan_id, self.cb_detectorkind.currentText())
+
+
     def forceLoad(self):
         '''
         A foolproof mechanism that forces users to click "load" before "start" or "view data frame".
@@ -1417,6 +1520,9 @@ class MainWindow(QtWidgets.QMainWindow, ui_ptycho.Ui_MainWindow):
                 self._exportConfigHelper(self._config_path)
                 #print("config file was written to " + self._config_path)
             self.close_mmap()
+            if self._prefetcher is not None:
+                self._prefetcher.stop()
+                self._prefetcher.wait()
         except:
             traceback.print_exc()
             raise
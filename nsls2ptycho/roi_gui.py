@@ -6,6 +6,7 @@ import numpy as np
 from nsls2ptycho.core.widgets.imgTools import find_outlier_pixels, find_brightest_pixels, rm_outlier_pixels
 from nsls2ptycho.core.ptycho_recon import HardWorker
 from nsls2ptycho.core.widgets.badpixel_dialog import BadPixelDialog
+from nsls2ptycho.core.detector_health import load_mask, get_bad_pixels
 from nsls2ptycho.core.databroker_api import save_data
 
 
@@ -45,6 +46,8 @@ class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
         self.cy = None
         self.sp_threshold.setValue(1.0)
         self._worker_thread = None
+        if main_window is not None:
+            self.cb_compression.setCurrentText(main_window.param.h5_compression)
 
     def reset_window(self):
         # When this function is called, self.canvas._on_reset() is also called
@@ -105,6 +108,15 @@ class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
 
         badpixels = find_outlier_pixels(roi_img)
 
+        # add the bad pixels found by the detector-health analysis of previous scans, if any
+        if self.main_window is not None:
+            masks = load_mask(self.main_window.param.detectorkind, shape=img.shape)
+            if masks is not None:
+                rows, cols = get_bad_pixels(masks)
+                rows, cols = np.array(rows, dtype=int) - y0, np.array(cols, dtype=int) - x0
+                inside = (rows >= 0) & (rows < roi_img.shape[0]) & (cols >= 0) & (cols < roi_img.shape[1])
+                badpixels = np.hstack((badpixels, [rows[inside], cols[inside]]))
+
         self.roi_width = roi_width
         self.roi_height = roi_height
         # TEST: ROI center
@@ -149,6 +161,9 @@ class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
         # get threshold
         threshold = self.sp_threshold.value()
 
+        # get the compression of the h5
+        p.h5_compression = self.cb_compression.currentText()
+
         # get bad pixels
         # TODO: need a better foolproof way
         # to update roi_width, roi_height, cx, cy
@@ -167,6 +182,20 @@ class RoiWindow(QtWidgets.QMainWindow, ui_roi.Ui_MainWindow):
             badpixels = None
             print("no bad pixels")
 
+        # the ROI window must be smaller than the detector image and lie within it, as zero
+        # padding is not supported
+        if self.canvas.image is None:
+            print("[ERROR] No image to select the ROI from.", file=sys.stderr)
+            return
+        height, width = self.canvas.image.shape
+        x0, y0 = self.cx - self.roi_width//2, self.cy - self.roi_height//2
+        if self.roi_width >= width or self.roi_height >= height or x0 < 0 or y0 < 0 \
+           or self.cx + self.roi_width//2 > width or self.cy + self.roi_height//2 > height:
+            print("[ERROR] The ROI window ({0}x{1} centered at ({2}, {3})) exceeds the detector image ({4}x{5}). "
+                  "Please choose a smaller ROI.".format(self.roi_width, self.roi_height, self.cx, self.cy,
+                                                        width, height), file=sys.stderr)
+            return
+
         # get blue rois
         blue_rois = self.canvas.get_blue_roi()
         #print(blue_rois)
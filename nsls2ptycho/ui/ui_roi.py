@@ -66,6 +66,16 @@ class Ui_MainWindow(object):
         self.btn_save_to_h5 = QtWidgets.QPushButton(self.groupBox)
         self.btn_save_to_h5.setGeometry(QtCore.QRect(410, 100, 89, 29))
         self.btn_save_to_h5.setObjectName("btn_save_to_h5")
+        self.label_3 = QtWidgets.QLabel(self.groupBox)
+        self.label_3.setGeometry(QtCore.QRect(215, 110, 85, 17))
+        self.label_3.setObjectName("label_3")
+        self.cb_compression = QtWidgets.QComboBox(self.groupBox)
+        self.cb_compression.setGeometry(QtCore.QRect(300, 105, 91, 27))
+        self.cb_compression.setObjectName("cb_compression")
+        self.cb_compression.addItem("")
+        self.cb_compression.addItem("")
+        self.cb_compression.addItem("")
+        self.cb_compression.addItem("")
         self.ck_logscale = QtWidgets.QCheckBox(self.groupBox)
         self.ck_logscale.setGeometry(QtCore.QRect(20, 20, 96, 22))
         self.ck_logscale.setObjectName("ck_logscale")
@@ -98,6 +108,11 @@ class Ui_MainWindow(object):
         self.ck_show_badpixels.setText(_translate("MainWindow", "show bad pixels"))
         self.btn_badpixels_correct.setText(_translate("MainWindow", "Correct"))
         self.btn_save_to_h5.setText(_translate("MainWindow", "save to h5"))
+        self.label_3.setText(_translate("MainWindow", "compression"))
+        self.cb_compression.setItemText(0, _translate("MainWindow", "none"))
+        self.cb_compression.setItemText(1, _translate("MainWindow", "gzip"))
+        self.cb_compression.setItemText(2, _translate("MainWindow", "lzf"))
+        self.cb_compression.setItemText(3, _translate("MainWindow", "blosc"))
         self.ck_logscale.setText(_translate("MainWindow", "log scale"))
         self.menuTools.setTitle(_translate("MainWindow", "Tools"))
         self.actionBadpixels.setText(_translate("MainWindow", "show badpixel list"))
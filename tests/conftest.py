@@ -0,0 +1,8 @@
+import os
+import sys
+
+# import the core modules as siblings, as their "for test purpose" fallbacks do, and the
+# reference implementations kept with the benchmarks
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'nsls2ptycho', 'core'))
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
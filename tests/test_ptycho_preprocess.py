@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from ptycho_preprocess import block_size, iter_blocks, preprocess_frames
+from legacy import preprocess_frames_loop
+
+
+def make_frames(num_frames=20, height=64, width=72, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = rng.poisson(3., size=(num_frames, height, width)).astype(np.uint32)
+    frames[3] = 0  # a dark frame
+    return rng, frames
+
+
+@pytest.mark.parametrize('n, nn, cx, cy', [(32, 32, 36, 32), (31, 17, 30, 25), (16, 40, 20, 40)])
+def test_matches_loop(n, nn, cx, cy):
+    rng, frames = make_frames()
+    out, dark = preprocess_frames(frames, n, nn, cx, cy)
+    ref, ref_dark = preprocess_frames_loop(frames, n, nn, cx, cy)
+    assert out.shape == ref.shape == (len(frames), n//2*2, nn//2*2)
+    np.testing.assert_allclose(out, ref)
+    np.testing.assert_array_equal(dark, ref_dark)
+    assert dark[3]
+
+
+def test_matches_loop_with_all_options():
+    rng, frames = make_frames()
+    height, width = frames.shape[1:]
+    scale = rng.uniform(0.9, 1.1, size=len(frames))
+    # the loop's 2x2 median window is only the same away from the top and left edges
+    bad_pixels = [list(rng.integers(1, height, 30)), list(rng.integers(1, width, 30))]
+    zero_out = [(30, 28, 5, 4), (0, 0, 3, 3)]
+    kwargs = dict(scale=scale, threshold=2., bad_pixels=bad_pixels, zero_out=zero_out)
+    out, dark = preprocess_frames(frames, 32, 24, 36, 30, **kwargs)
+    ref, ref_dark = preprocess_frames_loop(frames, 32, 24, 36, 30, **kwargs)
+    np.testing.assert_allclose(out, ref)
+    np.testing.assert_array_equal(dark, ref_dark)
+
+
+def test_blocks_match_whole_stack():
+    rng, frames = make_frames(num_frames=block_size + 7)
+    scale = rng.uniform(0.9, 1.1, size=len(frames))
+    ref, ref_dark = preprocess_frames_loop(frames, 32, 32, 36, 32, scale=scale, threshold=1.)
+    start = 0
+    for block in iter_blocks(frames):
+        stop = start + block.shape[0]
+        out, dark = preprocess_frames(block, 32, 32, 36, 32, scale=scale[start:stop], threshold=1.)
+        np.testing.assert_allclose(out, ref[start:stop])
+        np.testing.assert_array_equal(dark, ref_dark[start:stop])
+        start = stop
+    assert start == len(frames)
+
+
+def test_input_not_modified():
+    _, frames = make_frames()
+    copy = frames.copy()
+    preprocess_frames(frames, 32, 32, 36, 32, bad_pixels=[[5], [6]], zero_out=[(0, 0, 10, 10)])
+    np.testing.assert_array_equal(frames, copy)
+
+
+def test_roi_as_wide_as_frame():
+    _, frames = make_frames()
+    with pytest.raises(Exception, match="zero padding"):
+        preprocess_frames(frames, frames.shape[2], 32, frames.shape[2]//2, 32)